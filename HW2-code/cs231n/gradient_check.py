@@ -1,8 +1,11 @@
 from __future__ import print_function
-from past.builtins import xrange
+
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
-from random import randrange
 
 def eval_numerical_gradient(f, x, verbose=True, h=0.00001):
   """ 
@@ -108,10 +111,14 @@ def grad_check_sparse(f, x, analytic_grad, num_checks=10, h=1e-5):
   """
   sample a few random elements and only return numerical
   in this dimensions.
+
+  Returns an array of the num_checks relative errors; see
+  check_model_gradients for a checker with statistics and thresholds.
   """
 
-  for i in xrange(num_checks):
-    ix = tuple([randrange(m) for m in x.shape])
+  rel_errors = np.zeros(num_checks)
+  for i in np.arange(num_checks):
+    ix = tuple([np.random.randint(m) for m in x.shape])
 
     oldval = x[ix]
     x[ix] = oldval + h # increment by h
@@ -124,4 +131,368 @@ def grad_check_sparse(f, x, analytic_grad, num_checks=10, h=1e-5):
     grad_analytic = analytic_grad[ix]
     rel_error = abs(grad_numerical - grad_analytic) / (abs(grad_numerical) + abs(grad_analytic))
     print('numerical: %f analytic: %f, relative error: %e' % (grad_numerical, grad_analytic, rel_error))
+    rel_errors[i] = rel_error
+  return rel_errors
+
+
+def rel_error(x, y):
+  """ returns relative error """
+  return np.max(np.abs(x - y) / (np.maximum(1e-8, np.abs(x) + np.abs(y))))
+
+
+def _centered_difference(pos, neg, df, h):
+  """
+  (f(x + h v) - f(x - h v)) / 2h from the two outputs of f, projected on df
+  when f returns an array (subtracting before reducing, which loses less
+  precision than reducing first).
+  """
+  if df is None:
+    return (pos - neg) / (2 * h)
+  return np.sum((pos - neg) * df) / (2 * h)
+
+
+def _numerical_partials(f, x, df, h, coords, vectorized, batch_size,
+                        separable):
+  """
+  Centered differences of f at x along the flat coordinates coords.
+  """
+  grad = np.empty(len(coords))
+  if separable:
+    # Coordinates at the same offset within their example are perturbed
+    # together; each example's share is read from its own output rows.
+    num_examples = x.shape[0]
+    per_example = x.size // num_examples
+    offsets = coords % per_example
+    order = np.argsort(offsets, kind='stable')
+    starts = np.flatnonzero(np.diff(offsets[order], prepend=-1))
+    for group in np.split(order, starts[1:]):
+      ix = np.unravel_index(coords[group], x.shape)
+      oldval = x[ix].copy()
+      x[ix] = oldval + h
+      pos = f(x).copy()
+      x[ix] = oldval - h
+      neg = f(x)
+      x[ix] = oldval
+      rows = np.sum(((pos - neg) * df).reshape(num_examples, -1), axis=1)
+      grad[group] = rows[coords[group] // per_example] / (2 * h)
+    return grad
+
+  if not vectorized:
+    for n, c in enumerate(coords):
+      ix = np.unravel_index(c, x.shape)
+      oldval = x[ix]
+      x[ix] = oldval + h
+      pos = f(x)
+      if df is not None:
+        pos = pos.copy()
+      x[ix] = oldval - h
+      neg = f(x)
+      x[ix] = oldval
+      grad[n] = _centered_difference(pos, neg, df, h)
+    return grad
+
+  for start in range(0, len(coords), batch_size):
+    c = coords[start:start + batch_size]
+    K = len(c)
+    # Rows 0..K-1 of the stack are x + h e_c, rows K..2K-1 are x - h e_c.
+    X = np.repeat(x[np.newaxis], 2 * K, axis=0)
+    X_flat = X.reshape(2 * K, -1)
+    X_flat[np.arange(K), c] += h
+    X_flat[K + np.arange(K), c] -= h
+    vals = f(X)
+    diff = vals[:K] - vals[K:]
+    if df is not None:
+      diff = np.sum((diff * df).reshape(K, -1), axis=1)
+    grad[start:start + K] = diff / (2 * h)
+  return grad
+
+
+# (f, x, df, h, vectorized, batch_size, separable) shared with forked
+# workers; see eval_numerical_gradient_batched.
+_GRAD_JOB = None
+
+
+def _numerical_partials_job(coords):
+  return _numerical_partials(_GRAD_JOB[0], _GRAD_JOB[1], _GRAD_JOB[2],
+                             _GRAD_JOB[3], coords, *_GRAD_JOB[4:])
+
+
+def eval_numerical_gradient_batched(f, x, df=None, h=1e-5, coords=None,
+                                    separable=False, vectorized=False,
+                                    batch_size=64, num_workers=1):
+  """
+  Numerical gradient by centered differences, like eval_numerical_gradient
+  (df None) and eval_numerical_gradient_array (df given), but evaluated in
+  batches and in parallel.
+
+  Inputs:
+  - f: Function of x returning a scalar, or an array when df is given.
+  - x: The point (numpy array) to evaluate the gradient at.
+  - df: Upstream gradient of f's output, or None if f returns a scalar.
+  - h: Step size.
+  - coords: Optional flat indices of the coordinates to evaluate; defaults
+    to all of them.
+  - separable: If True, the rows of f's output along axis 0 only depend on
+    the matching rows of x, as for affine, relu, conv and pooling layers as
+    functions of x (not of their weights, nor for batchnorm in train mode).
+    One coordinate of every example is then perturbed in the same call, so
+    f is called N times fewer. Requires df.
+  - vectorized: If True, f accepts a stack of inputs of shape
+    (K,) + x.shape and returns the K stacked outputs. The +h and -h
+    perturbations of batch_size coordinates are then evaluated in a single
+    call to f.
+  - batch_size: Coordinates per call to f when vectorized.
+  - num_workers: Number of forked worker processes the coordinates are
+    split across; None uses the number of CPUs.
+
+  Returns:
+  - grad: Array of the shape of x if coords is None, otherwise an array of
+    shape (len(coords),) with the partial derivatives along coords.
+  """
+  global _GRAD_JOB
+  if separable and df is None:
+    raise ValueError('Invalid separable "%s" for a scalar f' % separable)
+  all_coords = coords is None
+  coords = np.arange(x.size) if all_coords else np.asarray(coords)
+  if num_workers is None:
+    num_workers = os.cpu_count() or 1
+  if 'fork' not in multiprocessing.get_all_start_methods():
+    num_workers = 1
+  num_workers = max(min(num_workers, len(coords)), 1)
+
+  if num_workers == 1:
+    grad = _numerical_partials(f, x, df, h, coords, vectorized, batch_size,
+                               separable)
+  else:
+    # Every worker perturbs its own copy-on-write copy of x.
+    _GRAD_JOB = (f, x, df, h, vectorized, batch_size, separable)
+    try:
+      context = multiprocessing.get_context('fork')
+      with ProcessPoolExecutor(num_workers, mp_context=context) as pool:
+        grad = np.concatenate(list(pool.map(
+            _numerical_partials_job, np.array_split(coords, 4 * num_workers))))
+    finally:
+      _GRAD_JOB = None
+
+  return grad.reshape(x.shape) if all_coords else grad
+
+
+def directional_gradient_check(f, x, analytic_grad, df=None, h=1e-5,
+                               num_directions=10, vectorized=False, seed=None):
+  """
+  Compares directional derivatives of f along random directions v, from two
+  evaluations of f per direction whatever the size of x, with the
+  analytic values sum(analytic_grad * v).
 
+  Inputs:
+  - f, x, df, h, vectorized: See eval_numerical_gradient_batched; if
+    vectorized, all directions are evaluated in a single call to f.
+  - analytic_grad: Analytic gradient of f at x.
+  - num_directions: Number of random unit directions.
+  - seed: Seed for the directions.
+
+  Returns a tuple of:
+  - numerical: Array of shape (num_directions,) of numerical derivatives.
+  - analytic: Array of shape (num_directions,) of analytic derivatives.
+  """
+  rng = np.random.default_rng(seed)
+  V = rng.standard_normal((num_directions,) + x.shape)
+  V /= np.sqrt(np.sum(V.reshape(num_directions, -1) ** 2, axis=1)).reshape(
+      (num_directions,) + (1,) * x.ndim)
+  analytic = np.sum((V * analytic_grad).reshape(num_directions, -1), axis=1)
+
+  if vectorized:
+    vals = f(np.concatenate((x + h * V, x - h * V)))
+    diff = vals[:num_directions] - vals[num_directions:]
+    if df is not None:
+      diff = np.sum((diff * df).reshape(num_directions, -1), axis=1)
+    numerical = diff / (2 * h)
+  else:
+    numerical = np.empty(num_directions)
+    for i in range(num_directions):
+      pos = f(x + h * V[i])
+      if df is not None:
+        pos = pos.copy()
+      numerical[i] = _centered_difference(pos, f(x - h * V[i]), df, h)
+  return numerical, analytic
+
+
+def check_gradient(f, x, analytic_grad, df=None, h=1e-5, num_directions=10,
+                   num_coords=100, separable=False, vectorized=False,
+                   batch_size=64, num_workers=1, seed=None, verbose=True):
+  """
+  Fast gradient check: random directional derivatives, which cover every
+  coordinate at once, plus centered differences on num_coords random
+  coordinates, which locate errors.
+
+  Inputs:
+  - f, x, df, h, separable, vectorized, batch_size, num_workers: See
+    eval_numerical_gradient_batched.
+  - analytic_grad: Analytic gradient of f at x.
+  - num_directions: Number of random directions; see
+    directional_gradient_check.
+  - num_coords: Number of coordinates checked; None checks all of them.
+  - seed: Seed for the directions and coordinates.
+  - verbose: If true, print the summary.
+
+  Returns a dictionary with:
+  - directional_rel_error: Max relative error over the directions.
+  - coordinate_rel_error: Max relative error over the coordinates.
+  - max_rel_error: Max of the two.
+  - worst_index: Index in x of the coordinate with the largest error.
+  - num_evals: Number of points f was evaluated at.
+  - time: Elapsed seconds.
+  """
+  tic = time.time()
+  rng = np.random.default_rng(seed)
+  dir_num, dir_ana = directional_gradient_check(
+      f, x, analytic_grad, df, h, num_directions, vectorized, seed=rng)
+  directional_rel_error = 0.0
+  if num_directions:
+    directional_rel_error = rel_error(dir_num, dir_ana)
+
+  if num_coords is None or num_coords >= x.size:
+    coords = np.arange(x.size)
+  else:
+    coords = rng.choice(x.size, num_coords, replace=False)
+  coord_num = eval_numerical_gradient_batched(
+      f, x, df, h, coords, separable, vectorized, batch_size, num_workers)
+  coord_ana = analytic_grad.reshape(-1)[coords]
+  num_evals = 2 * num_directions
+  if separable:
+    num_evals += 2 * len(np.unique(coords % (x.size // x.shape[0])))
+  else:
+    num_evals += 2 * len(coords)
+  errors = np.abs(coord_num - coord_ana) / np.maximum(
+      1e-8, np.abs(coord_num) + np.abs(coord_ana))
+  coordinate_rel_error = np.max(errors) if len(coords) else 0.0
+  worst = coords[np.argmax(errors)] if len(coords) else 0
+
+  stats = {
+    'directional_rel_error': directional_rel_error,
+    'coordinate_rel_error': coordinate_rel_error,
+    'max_rel_error': max(directional_rel_error, coordinate_rel_error),
+    'worst_index': tuple(int(i) for i in np.unravel_index(worst, x.shape)),
+    'num_evals': num_evals,
+    'time': time.time() - tic,
+  }
+  if verbose:
+    print('directional rel error: %e, coordinate rel error: %e (worst at %s), '
+          '%d evaluations in %.2fs' % (
+              stats['directional_rel_error'], stats['coordinate_rel_error'],
+              stats['worst_index'], stats['num_evals'], stats['time']))
+  return stats
+
+
+def _sparse_check(targets, num_checks, h, threshold, num_workers, seed,
+                  verbose):
+  """
+  Checks a random sample of coordinates of every target, with the same
+  number of coordinates per target so that small parameters (biases, batch
+  normalization scales) are checked as thoroughly as large weights.
+
+  Inputs:
+  - targets: List of (name, x, analytic_grad, f, df) tuples; see
+    eval_numerical_gradient_batched for f and df.
+  - num_checks, h, threshold, num_workers, seed, verbose: See
+    check_model_gradients.
+  """
+  rng = np.random.default_rng(seed)
+  per_target = max(num_checks // max(len(targets), 1), 1)
+  stats = {}
+  for name, x, analytic_grad, f, df in targets:
+    coords = rng.choice(x.size, min(per_target, x.size), replace=False)
+    numerical = eval_numerical_gradient_batched(f, x, df, h, coords,
+                                                num_workers=num_workers)
+    analytic = analytic_grad.reshape(-1)[coords]
+    errors = np.abs(numerical - analytic) / np.maximum(
+        1e-8, np.abs(numerical) + np.abs(analytic))
+    worst = np.argmax(errors)
+    limit = threshold.get(name) if isinstance(threshold, dict) else threshold
+    stats[name] = {
+      'max_rel_error': float(errors[worst]),
+      'mean_rel_error': float(np.mean(errors)),
+      'median_rel_error': float(np.median(errors)),
+      'num_checks': len(coords),
+      'worst_index': tuple(int(i) for i in
+                           np.unravel_index(coords[worst], x.shape)),
+      'passed': bool(limit is None or errors[worst] <= limit),
+    }
+    if verbose:
+      print('%s max relative error: %e, median: %e (%d checks)' % (
+          name, errors[worst], stats[name]['median_rel_error'], len(coords)))
+    # Fail fast, before checking the remaining targets.
+    if not stats[name]['passed']:
+      raise AssertionError(
+          'Gradient check failed for %s: relative error %e > %e at %s' % (
+              name, errors[worst], limit, stats[name]['worst_index']))
+  return stats
+
+
+def check_model_gradients(model, X, y, num_checks=100, h=1e-5,
+                          threshold=None, num_workers=1, seed=None,
+                          verbose=True):
+  """
+  Sparse gradient check of model.loss(X, y) with respect to every array in
+  model.params, e.g. for TwoLayerNet, FullyConnectedNet or
+  ThreeLayerConvNet. Usable as a regression gate with threshold.
+
+  Inputs:
+  - model: Object with a params dictionary and a loss(X, y) method returning
+    (loss, grads), with grads keyed like params.
+  - X, y: Data the loss is evaluated on.
+  - num_checks: Total number of coordinates checked, split evenly across the
+    parameters.
+  - h: Step size.
+  - threshold: None, a maximum relative error, or a dictionary mapping
+    parameter names to maximum relative errors. An AssertionError is raised
+    as soon as a parameter exceeds its threshold.
+  - num_workers: Number of forked processes evaluating the coordinates of
+    each parameter; None uses the number of CPUs.
+  - seed: Seed for the coordinate sample.
+  - verbose: If true, print one summary line per parameter.
+
+  Returns a dictionary mapping each parameter name to a dictionary with
+  max_rel_error, mean_rel_error, median_rel_error, num_checks, worst_index
+  and passed.
+  """
+  _, grads = model.loss(X, y)
+  loss = lambda p: model.loss(X, y)[0]
+  targets = [(name, model.params[name], grads[name], loss, None)
+             for name in sorted(model.params)]
+  return _sparse_check(targets, num_checks, h, threshold, num_workers, seed,
+                       verbose)
+
+
+def check_layer_gradients(forward, backward, inputs, args=(), num_checks=100,
+                          h=1e-5, threshold=None, num_workers=1, seed=None,
+                          verbose=True):
+  """
+  Sparse gradient check of a layer's backward pass against its forward pass,
+  e.g. check_layer_gradients(conv_forward_naive, conv_backward_naive,
+  (x, w, b), (conv_param,)).
+
+  Inputs:
+  - forward: Function forward(*inputs, *args) returning (out, cache).
+  - backward: Function backward(dout, cache) returning the gradients with
+    respect to inputs, in order (extra return values are ignored).
+  - inputs: Tuple of numpy arrays the gradients are checked for.
+  - args: Tuple of extra arguments for forward (e.g. conv_param).
+  - num_checks, h, threshold, num_workers, seed, verbose: See
+    check_model_gradients; inputs are named 'input0', 'input1', ...
+
+  Returns a dictionary mapping each input name to its error statistics; see
+  check_model_gradients.
+  """
+  rng = np.random.default_rng(seed)
+  out, cache = forward(*(tuple(inputs) + tuple(args)))
+  dout = rng.standard_normal(out.shape)
+  grads = backward(dout, cache)
+  if not isinstance(grads, tuple):
+    grads = (grads,)
+  inputs = tuple(inputs)
+  layer_out = lambda p: forward(*(inputs + tuple(args)))[0]
+  targets = [('input%d' % i, x, grads[i], layer_out, dout)
+             for i, x in enumerate(inputs)]
+  return _sparse_check(targets, num_checks, h, threshold, num_workers, rng,
+                       verbose)
@@ -1,3 +1,7 @@
 from .svm import *
 from .knn import *
+from .knn_metrics import *
+from .knn_storage import *
+from .knn_index import *
 from .softmax import *
+from .linear_train import *
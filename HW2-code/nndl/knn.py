@@ -1,23 +1,272 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import numpy as np
 import pdb
 
+from .knn_metrics import get_metric
+from .knn_storage import CompactStorage
+
 """
 This code was based off of code from cs231n at Stanford University, and modified for ECE C147/C247 at UCLA.
 """
 
+def _merge_topk(best_d, best_i, d, offset, k):
+  """
+  Merges a (B, T) block of distances d, whose columns are training indices
+  offset, ..., offset + T - 1, into the running (B, k) top-k arrays.
+  """
+  if d.shape[1] > k:
+    part = np.argpartition(d, k - 1, axis=1)[:, :k]
+    d = np.take_along_axis(d, part, axis=1)
+  else:
+    part = np.broadcast_to(np.arange(d.shape[1]), d.shape)
+  cand_d = np.concatenate((best_d, d), axis=1)
+  cand_i = np.concatenate((best_i, part + offset), axis=1)
+  sel = np.argpartition(cand_d, k - 1, axis=1)[:, :k]
+  return (np.take_along_axis(cand_d, sel, axis=1),
+          np.take_along_axis(cand_i, sel, axis=1))
+
+
+def _tile_shape(num_test, num_train, bytes_per_pair, max_memory, num_workers,
+                bytes_per_row=0):
+  """
+  Chooses (test_block, train_tile) so that num_workers tiles in flight use
+  roughly max_memory bytes in total. bytes_per_row is the size of any
+  per-training-row copy (e.g. decoded compact data) made for each tile.
+  """
+  pairs = max(int(max_memory // (bytes_per_pair * num_workers)), 1)
+  train_tile = min(num_train, max(pairs // 64, 1))
+  if bytes_per_row:
+    rows = int(max_memory // (2 * bytes_per_row * num_workers))
+    train_tile = min(train_tile, max(rows, 1))
+  per_worker = -(-num_test // num_workers)
+  test_block = max(min(per_worker, pairs // train_tile), 1)
+  return test_block, train_tile
+
+
+def blocked_topk(X, num_train, k, dist_fn, bytes_per_pair, max_memory=2**28,
+                 num_threads=None, bytes_per_row=0):
+  """
+  Finds the k smallest distances from each row of X to num_train training
+  points without materializing the (num_test, num_train) matrix.
+
+  Inputs:
+  - X: A numpy array of shape (num_test, D) containing test data.
+  - num_train: Number of training points.
+  - k: Number of neighbors to keep.
+  - dist_fn: dist_fn(X_block, start, end) returns the (B, end - start)
+    distances between X_block and training points start, ..., end - 1.
+  - bytes_per_pair: Approximate bytes of temporaries dist_fn and the top-k
+    merge need per (test, train) pair; used to size the tiles.
+  - max_memory: Approximate cap, in bytes, on the tile memory in flight.
+  - num_threads: Number of test blocks processed concurrently; defaults to
+    the number of CPUs.
+  - bytes_per_row: Bytes dist_fn allocates per training row of a tile.
+
+  Returns a tuple of:
+  - dists: Array of shape (num_test, k), sorted in increasing order.
+  - idx: Array of shape (num_test, k) of the matching training indices.
+  """
+  num_test = X.shape[0]
+  k = min(k, num_train)
+  if num_threads is None:
+    num_threads = os.cpu_count() or 1
+  test_block, train_tile = _tile_shape(num_test, num_train, bytes_per_pair,
+                                       max_memory, num_threads, bytes_per_row)
+
+  dists = np.empty((num_test, k))
+  idx = np.empty((num_test, k), dtype=np.int64)
+
+  def run(start):
+    X_block = X[start:start + test_block]
+    best_d = np.full((X_block.shape[0], k), np.inf)
+    best_i = np.full((X_block.shape[0], k), -1, dtype=np.int64)
+    for t in range(0, num_train, train_tile):
+      d = dist_fn(X_block, t, min(t + train_tile, num_train))
+      best_d, best_i = _merge_topk(best_d, best_i, d, t, k)
+    order = np.argsort(best_d, axis=1)
+    dists[start:start + test_block] = np.take_along_axis(best_d, order, axis=1)
+    idx[start:start + test_block] = np.take_along_axis(best_i, order, axis=1)
+
+  starts = range(0, num_test, test_block)
+  if num_threads == 1:
+    for start in starts:
+      run(start)
+  else:
+    # numpy releases the GIL inside the matrix products and partitions, so
+    # test blocks run concurrently on threads without copying X_train.
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+      list(pool.map(run, starts))
+
+  return dists, idx
+
+
+def metric_kneighbors(X, metric, k=1, max_memory=2**28, num_threads=None):
+  """
+  Exact k nearest neighbors under a fitted metric from nndl.knn_metrics,
+  using blocked_topk.
+
+  Returns a tuple of:
+  - dists: Array of shape (num_test, k) of increasing distances.
+  - idx: Array of shape (num_test, k) of the matching training indices.
+  """
+  dists, idx = blocked_topk(metric.query(X), metric.num_train, k, metric.tile,
+                            metric.bytes_per_pair(), max_memory, num_threads,
+                            metric.bytes_per_row())
+  return metric.finalize(dists), idx
+
+
+def rerank_candidates(X, X_train, candidates, metric, k=1, max_memory=2**28):
+  """
+  Recomputes the distances between each test point and its candidate
+  training points under a fitted metric, and keeps the k closest.
+
+  Inputs:
+  - X: A numpy array of shape (num_test, D) containing test data.
+  - X_train: The training data the candidates index into; only the
+    candidate rows are read.
+  - candidates: Array of shape (num_test, m) of training indices.
+  - metric: A metric from nndl.knn_metrics fitted to X_train.
+  - k: Number of neighbors to keep.
+  - max_memory: Approximate cap, in bytes, on the gathered candidate rows.
+
+  Returns a tuple of:
+  - dists: Array of shape (num_test, k) of increasing distances.
+  - idx: Array of shape (num_test, k) of the matching training indices.
+  """
+  X = metric.query(X)
+  num_test, m = candidates.shape
+  k = min(k, m)
+  row_bytes = 3 * m * X.shape[1] * metric.dtype.itemsize
+  block = max(int(max_memory // row_bytes), 1)
+
+  dists = np.empty((num_test, k))
+  idx = np.empty((num_test, k), dtype=np.int64)
+  for start in range(0, num_test, block):
+    cand = candidates[start:start + block]
+    d = metric.paired(X[start:start + block], X_train[cand])
+    order = np.argsort(d, axis=1)[:, :k]
+    dists[start:start + block] = np.take_along_axis(d, order, axis=1)
+    idx[start:start + block] = np.take_along_axis(cand, order, axis=1)
+  return dists, idx
+
+
+def l2_kneighbors(X, X_train, k=1, max_memory=2**28, num_threads=None):
+  """
+  Exact k nearest neighbors in L2 distance; see metric_kneighbors.
+  """
+  return metric_kneighbors(X, get_metric('l2', X_train), k, max_memory,
+                           num_threads)
+
+
+def pairwise_distances(X, metric, max_memory=2**28, num_threads=None):
+  """
+  Full (num_test, num_train) distance matrix under a fitted metric from
+  nndl.knn_metrics, computed tile by tile so that the temporaries stay
+  within max_memory on top of the output itself.
+  """
+  X = metric.query(X)
+  num_test, num_train = X.shape[0], metric.num_train
+  if num_threads is None:
+    num_threads = os.cpu_count() or 1
+  test_block, train_tile = _tile_shape(num_test, num_train,
+                                       metric.bytes_per_pair(), max_memory,
+                                       num_threads, metric.bytes_per_row())
+  dists = np.empty((num_test, num_train), dtype=metric.dtype)
+
+  def run(start):
+    X_block = X[start:start + test_block]
+    for t in range(0, num_train, train_tile):
+      end = min(t + train_tile, num_train)
+      dists[start:start + test_block, t:end] = \
+          metric.finalize(metric.tile(X_block, t, end))
+
+  with ThreadPoolExecutor(max_workers=num_threads) as pool:
+    list(pool.map(run, range(0, num_test, test_block)))
+  return dists
+
+
+def _majority_vote(neighbor_labels, num_classes, neighbor_dists=None):
+  """
+  Batched majority vote over the rows of a (num_test, k) label array. Ties
+  are broken by choosing the smaller label.
+
+  If neighbor_dists is given, each neighbor's vote is weighted by the
+  inverse of its distance instead of counting once.
+  """
+  num_test = neighbor_labels.shape[0]
+  offsets = np.arange(num_test)[:, np.newaxis] * num_classes
+  weights = None
+  if neighbor_dists is not None:
+    weights = (1.0 / np.maximum(neighbor_dists, 1e-12)).ravel()
+  counts = np.bincount((neighbor_labels + offsets).ravel(), weights=weights,
+                       minlength=num_test * num_classes)
+  return np.argmax(counts.reshape(num_test, num_classes), axis=1)
+
+
+# Folds shared with forked cross-validation workers; see KNN.cross_validate.
+_CV_FOLDS = None
+
+
+def _fold_errors(i, ks, weights, metric, max_memory, num_threads):
+  """
+  Validation error rates on fold i of _CV_FOLDS for every k in ks, from a
+  single neighbor search for the largest k.
+  """
+  X_folds, y_folds = _CV_FOLDS
+  X_train = np.concatenate(X_folds[:i] + X_folds[i + 1:])
+  y_train = np.concatenate(y_folds[:i] + y_folds[i + 1:])
+  num_classes = np.max(y_train) + 1
+
+  dists, idx = metric_kneighbors(X_folds[i], get_metric(metric, X_train),
+                                 max(ks), max_memory, num_threads)
+  labels = y_train[idx]
+  errors = []
+  for k in ks:
+    # Neighbors come back sorted, so the first k columns are the k nearest.
+    pred = _majority_vote(labels[:, :k], num_classes,
+                          dists[:, :k] if weights == 'distance' else None)
+    errors.append(np.mean(pred != y_folds[i]))
+  return errors
+
+
 class KNN(object):
 
   def __init__(self):
-    pass
+    self.index = None
+    self.storage = None
+    self.metrics = {}
 
-  def train(self, X, y):
+  def train(self, X, y, index=None, storage=None, num_components=None,
+            **index_params):
     """
 	Inputs:
 	- X is a numpy array of size (num_examples, D)
 	- y is a numpy array of size (num_examples, )
+	- index: Optional approximate nearest-neighbor index used by kneighbors
+	  and predict: either the name of an index type in
+	  nndl.knn_index.INDEX_TYPES, built here on X with index_params, or an
+	  already fitted index (e.g. from nndl.knn_index.load_index).
+	- storage: Optional compact copy of X that kneighbors and predict scan
+	  instead of X: either a storage type in
+	  nndl.knn_storage.CompactStorage.dtypes ('float32', 'float16' or
+	  'int8'), built here on X, or an already fitted CompactStorage. X
+	  itself is then only read to re-rank the candidates.
+	- num_components: If storage is a type name, the compact copy is
+	  reduced to this many principal components.
     """
     self.X_train = X
     self.y_train = y
+    self.metrics = {}
+    if isinstance(index, str):
+      from .knn_index import build_index
+      index = build_index(index, X, **index_params)
+    self.index = index
+    if isinstance(storage, str):
+      storage = CompactStorage(storage, num_components).fit(X)
+    self.storage = storage
 
   def compute_distances(self, X, norm=None):
     """
@@ -26,7 +275,10 @@ class KNN(object):
 
     Inputs:
     - X: A numpy array of shape (num_test, D) containing test data.
-	- norm: the function with which the norm is taken.
+	- norm: the function with which the norm is taken, or the name of a
+	  metric in nndl.knn_metrics.METRICS (e.g. 'l1', 'linf', 'cosine'),
+	  which is computed in vectorized tiles instead of element by element.
+	  Defaults to 'l2'.
 
     Returns:
     - dists: A numpy array of shape (num_test, num_train) where dists[i, j]
@@ -34,8 +286,9 @@ class KNN(object):
       point.
     """
     if norm is None:
-      norm = lambda x: np.sqrt(np.sum(x**2))
-      #norm = 2
+      norm = 'l2'
+    if isinstance(norm, str):
+      return pairwise_distances(X, self.get_metric(norm))
 
     num_test = X.shape[0]
     num_train = self.X_train.shape[0]
@@ -98,8 +351,146 @@ class KNN(object):
 
     return dists
 
+  def get_metric(self, metric, **metric_params):
+    """
+    Returns the metric named metric fitted to self.X_train. Metrics without
+    extra parameters are cached until the next call to train(), so their
+    precomputation (norms, whitening) is done once.
+    """
+    if metric_params:
+      return get_metric(metric, self.X_train, **metric_params)
+    if metric not in self.metrics:
+      self.metrics[metric] = get_metric(metric, self.X_train)
+    return self.metrics[metric]
+
+  def kneighbors(self, X, k=1, metric='l2', max_memory=2**28,
+                 num_threads=None, rerank=4, **metric_params):
+    """
+    Finds the k nearest training points of each test point in X, processing
+    test and training points in tiles so that the full (num_test, num_train)
+    distance matrix is never built. If train() was given an index, L2
+    searches are delegated to it instead; test points for which it finds
+    fewer than k candidates are searched exactly.
+
+    If train() was given a storage, the compact copy is searched for
+    rerank * k candidates, which are then re-ranked with the full precision
+    training data.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) containing test data.
+    - k: The number of nearest neighbors.
+    - metric: Name of a metric in nndl.knn_metrics.METRICS.
+    - max_memory: Approximate cap, in bytes, on the distance tiles in flight.
+    - num_threads: Number of threads; defaults to the number of CPUs.
+    - rerank: Candidates per neighbor re-ranked in full precision when a
+      storage is used; 0 returns the neighbors and distances found on the
+      compact data.
+    - metric_params: Extra keyword arguments for the metric. With a storage,
+      they only apply to the re-ranking.
+
+    Returns a tuple of:
+    - dists: A numpy array of shape (num_test, k) of increasing distances.
+    - idx: A numpy array of shape (num_test, k) of training indices.
+    """
+    if self.index is not None and metric == 'l2':
+      dists, idx = self.index.search(X, k)
+      missing = np.any(idx < 0, axis=1)
+      if np.any(missing):
+        dists[missing], idx[missing] = metric_kneighbors(
+            X[missing], self.get_metric('l2'), k, max_memory, num_threads)
+      return dists, idx
+    if self.storage is None:
+      return metric_kneighbors(X, self.get_metric(metric, **metric_params), k,
+                               max_memory, num_threads)
+
+    key = (metric, 'storage')
+    if key not in self.metrics:
+      self.metrics[key] = get_metric(metric, self.storage)
+    num_candidates = k if not rerank else rerank * k
+    dists, idx = metric_kneighbors(self.storage.transform(X), self.metrics[key],
+                                   num_candidates, max_memory, num_threads)
+    if not rerank:
+      return dists, idx
+    return rerank_candidates(X, self.X_train, idx,
+                             self.get_metric(metric, **metric_params), k,
+                             max_memory)
 
-  def predict_labels(self, dists, k=1):
+  def predict(self, X, k=1, weights='uniform', metric='l2', max_memory=2**28,
+              num_threads=None, rerank=4, **metric_params):
+    """
+    Predicts labels for the test points in X with the memory-bounded
+    neighbor search in kneighbors.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) containing test data.
+    - k: The number of nearest neighbors that vote.
+    - weights: 'uniform' or 'distance'; see predict_labels.
+    - metric, max_memory, num_threads, rerank, metric_params: See
+      kneighbors.
+
+    Returns:
+    - y: A numpy array of shape (num_test,) containing predicted labels.
+    """
+    if weights not in ('uniform', 'distance'):
+      raise ValueError('Invalid weights "%s"' % weights)
+
+    dists, idx = self.kneighbors(X, k=k, metric=metric, max_memory=max_memory,
+                                 num_threads=num_threads, rerank=rerank,
+                                 **metric_params)
+    return _majority_vote(self.y_train[idx], np.max(self.y_train) + 1,
+                          dists if weights == 'distance' else None)
+
+  def cross_validate(self, X_folds, y_folds, ks, weights='uniform',
+                     metric='l2', num_workers=None, max_memory=2**28):
+    """
+    k-fold cross-validation of the KNN classifier over many values of k.
+
+    Each fold's neighbors are searched once for the largest k and every
+    candidate k is scored from that sorted prefix, so the sweep costs one
+    distance computation per fold instead of one per (fold, k) pair. Folds
+    run in parallel worker processes.
+
+    Inputs:
+    - X_folds: List of arrays of shape (num_fold_examples, D), one per fold.
+    - y_folds: List of the matching label arrays.
+    - ks: List of candidate values of k.
+    - weights: 'uniform' or 'distance'; see predict_labels.
+    - metric: Name of a metric in nndl.knn_metrics.METRICS.
+    - num_workers: Number of processes; defaults to one per fold (capped at
+      the number of CPUs). 1 runs the folds in this process.
+    - max_memory: See kneighbors; applies to each worker.
+
+    Returns:
+    - errors: A numpy array of shape (num_folds, len(ks)) where errors[i, j]
+      is the validation error rate on fold i with k = ks[j].
+    """
+    global _CV_FOLDS
+    num_folds = len(X_folds)
+    if num_workers is None:
+      num_workers = min(num_folds, os.cpu_count() or 1)
+    # Workers inherit the folds through fork instead of pickling them, so
+    # fall back to serial evaluation where fork is unavailable.
+    if 'fork' not in multiprocessing.get_all_start_methods():
+      num_workers = 1
+
+    _CV_FOLDS = (list(X_folds), list(y_folds))
+    try:
+      if num_workers == 1:
+        errors = [_fold_errors(i, ks, weights, metric, max_memory, None)
+                  for i in range(num_folds)]
+      else:
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(num_workers, mp_context=context) as pool:
+          futures = [pool.submit(_fold_errors, i, ks, weights, metric,
+                                 max_memory, 1)
+                     for i in range(num_folds)]
+          errors = [f.result() for f in futures]
+    finally:
+      _CV_FOLDS = None
+
+    return np.array(errors)
+
+  def predict_labels(self, dists, k=1, weights='uniform'):
     """
     Given a matrix of distances between test points and training points,
     predict a label for each test point.
@@ -107,35 +498,37 @@ class KNN(object):
     Inputs:
     - dists: A numpy array of shape (num_test, num_train) where dists[i, j]
       gives the distance betwen the ith test point and the jth training point.
+    - k: The number of nearest neighbors that vote.
+    - weights: 'uniform' gives every neighbor one vote; 'distance' weights
+      each vote by the inverse distance to the neighbor.
 
     Returns:
     - y: A numpy array of shape (num_test,) containing predicted labels for the
       test data, where y[i] is the predicted label for the test point X[i].  
     """
-    num_test = dists.shape[0]
-    y_pred = np.zeros(num_test)
-    for i in np.arange(num_test):
-      # A list of length k storing the labels of the k nearest neighbors to
-      # the ith test point.
-      closest_y = []
-  	  # ================================================================ #
-  	  # YOUR CODE HERE:
-  	  #   Use the distances to calculate and then store the labels of 
-	  #   the k-nearest neighbors to the ith test point.  The function
-	  #   numpy.argsort may be useful.
-	  #   
-	  #   After doing this, find the most common label of the k-nearest
-	  #   neighbors.  Store the predicted label of the ith training example
-	  #   as y_pred[i].  Break ties by choosing the smaller label.
-  	  # ================================================================ #
-  
-      closest_train = np.argsort(dists[i])[:k]
-      closest_y = self.y_train[closest_train]
-      
-      y_pred[i] = np.argmax(np.bincount(closest_y))
-
-  	  # ================================================================ #
-  	  # END YOUR CODE HERE
-  	  # ================================================================ #
+    if weights not in ('uniform', 'distance'):
+      raise ValueError('Invalid weights "%s"' % weights)
+
+    # ================================================================ #
+    # YOUR CODE HERE:
+    #   Use the distances to calculate and then store the labels of 
+    #   the k-nearest neighbors to each test point, then find the most
+    #   common label.  Break ties by choosing the smaller label.
+    # ================================================================ #
+
+    # A single partial sort over the whole matrix finds the k nearest
+    # training points of every row; their order does not matter for voting.
+    k = min(k, dists.shape[1])
+    closest_train = np.argpartition(dists, k - 1, axis=1)[:, :k]
+    closest_y = self.y_train[closest_train]
+    closest_dists = None
+    if weights == 'distance':
+      closest_dists = np.take_along_axis(dists, closest_train, axis=1)
+
+    y_pred = _majority_vote(closest_y, np.max(self.y_train) + 1, closest_dists)
+
+    # ================================================================ #
+    # END YOUR CODE HERE
+    # ================================================================ #
 
     return y_pred
@@ -0,0 +1,200 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from .knn import _merge_topk, l2_kneighbors
+
+"""
+Approximate nearest-neighbor indexes for the KNN classifier.
+
+An index is fitted once on the training data and then answers repeated
+queries without scanning every training point. Indexes are selected by name
+through INDEX_TYPES (see KNN.train), and can be saved to and loaded from a
+single .npz file.
+"""
+
+
+class IVFIndex(object):
+  """
+  Inverted-file index with a k-means coarse quantizer.
+
+  The training points are clustered into num_lists cells. A query only
+  computes exact distances to the points of the num_probe cells whose
+  centroids are closest to it, so raising num_probe trades speed for
+  recall (num_probe = num_lists is an exact search).
+  """
+
+  kind = 'ivf'
+
+  def __init__(self, num_lists=100, num_probe=8, num_iters=10,
+               sample_size=None, seed=None):
+    """
+    Inputs:
+    - num_lists: Number of k-means cells.
+    - num_probe: Number of cells searched per query.
+    - num_iters: Number of k-means iterations.
+    - sample_size: Number of training points k-means is run on; defaults to
+      256 points per cell.
+    - seed: Seed for the k-means initialization and sampling.
+    """
+    self.num_lists = num_lists
+    self.num_probe = num_probe
+    self.num_iters = num_iters
+    self.sample_size = sample_size
+    self.seed = seed
+
+  def fit(self, X):
+    """
+    Clusters X and stores its rows grouped by cell.
+
+    Inputs:
+    - X: A numpy array of shape (num_train, D) containing training data.
+    """
+    rng = np.random.default_rng(self.seed)
+    X = X.astype(np.result_type(X.dtype, np.float32), copy=False)
+    N = X.shape[0]
+    num_lists = min(self.num_lists, N)
+
+    sample_size = self.sample_size or 256 * num_lists
+    sample = X[np.sort(rng.choice(N, min(N, sample_size), replace=False))]
+    centroids = sample[rng.choice(sample.shape[0], num_lists, replace=False)]
+    for _ in range(self.num_iters):
+      assign = l2_kneighbors(sample, centroids, 1)[1][:, 0]
+      counts = np.bincount(assign, minlength=num_lists)
+      # Per-cell sums as a sparse (num_lists, sample_size) one-hot product.
+      members = csr_matrix((np.ones(assign.size, dtype=sample.dtype),
+                            (assign, np.arange(assign.size))),
+                           shape=(num_lists, assign.size))
+      sums = members.dot(sample)
+      # Empty cells keep their previous centroid.
+      nonempty = counts > 0
+      centroids[nonempty] = sums[nonempty] / counts[nonempty][:, np.newaxis]
+
+    assign = l2_kneighbors(X, centroids, 1)[1][:, 0]
+    self.centroids = centroids
+    self.list_order = np.argsort(assign, kind='stable')
+    self.list_offsets = np.concatenate(
+        ([0], np.cumsum(np.bincount(assign, minlength=num_lists))))
+    # A contiguous copy of the training data grouped by cell, so each probed
+    # cell is a single slice.
+    self.X_lists = X[self.list_order]
+    return self
+
+  def search(self, X, k=1):
+    """
+    Finds approximate k nearest neighbors of each row of X.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) containing test data.
+    - k: The number of nearest neighbors.
+
+    Returns a tuple of:
+    - dists: A numpy array of shape (num_test, k) of increasing distances.
+    - idx: A numpy array of shape (num_test, k) of training indices. If fewer
+      than k candidates are found, the missing entries are -1 (with an
+      infinite distance).
+    """
+    X = X.astype(self.X_lists.dtype, copy=False)
+    num_test = X.shape[0]
+    num_probe = min(self.num_probe, self.centroids.shape[0])
+    probes = l2_kneighbors(X, self.centroids, num_probe)[1]
+
+    # Group the (query, cell) pairs by cell so that every cell is visited
+    # once, with all the queries that probe it.
+    flat = probes.ravel()
+    queries = np.repeat(np.arange(num_test), num_probe)
+    order = np.argsort(flat, kind='stable')
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(
+        flat, minlength=self.centroids.shape[0]))))
+
+    best_d = np.full((num_test, k), np.inf)
+    best_i = np.full((num_test, k), -1, dtype=np.int64)
+    X_squared = np.sum(np.square(X), axis=1)
+    for cell in np.unique(flat):
+      start, end = self.list_offsets[cell], self.list_offsets[cell + 1]
+      if start == end:
+        continue
+      qs = queries[order[bounds[cell]:bounds[cell + 1]]]
+      X_cell = self.X_lists[start:end]
+      d = np.dot(X[qs], X_cell.T)
+      d *= -2
+      d += X_squared[qs][:, np.newaxis]
+      d += np.sum(np.square(X_cell), axis=1)
+      best_d[qs], best_i[qs] = _merge_topk(best_d[qs], best_i[qs], d, start, k)
+
+    sort = np.argsort(best_d, axis=1)
+    best_d = np.take_along_axis(best_d, sort, axis=1)
+    best_i = np.take_along_axis(best_i, sort, axis=1)
+    valid = best_i >= 0
+    idx = np.where(valid, self.list_order[np.where(valid, best_i, 0)], -1)
+    dists = np.where(valid, np.sqrt(np.maximum(best_d, 0)), np.inf)
+    return dists, idx
+
+  def get_state(self):
+    return {
+      'num_probe': self.num_probe,
+      'centroids': self.centroids,
+      'list_order': self.list_order,
+      'list_offsets': self.list_offsets,
+      'X_lists': self.X_lists,
+    }
+
+  def set_state(self, state):
+    self.num_probe = int(state['num_probe'])
+    self.centroids = state['centroids']
+    self.num_lists = self.centroids.shape[0]
+    self.list_order = state['list_order']
+    self.list_offsets = state['list_offsets']
+    self.X_lists = state['X_lists']
+    return self
+
+  def save(self, path):
+    """
+    Saves the fitted index, including its copy of the training data, to a
+    .npz file that load_index can read.
+    """
+    np.savez(path, kind=self.kind, **self.get_state())
+
+
+INDEX_TYPES = {
+  'ivf': IVFIndex,
+}
+
+
+def build_index(name, X, **params):
+  """
+  Builds and fits the index registered under name in INDEX_TYPES.
+
+  Inputs:
+  - name: Index type, e.g. 'ivf'.
+  - X: A numpy array of shape (num_train, D) containing training data.
+  - params: Keyword arguments for the index constructor.
+  """
+  if name not in INDEX_TYPES:
+    raise ValueError('Invalid index "%s"' % name)
+  return INDEX_TYPES[name](**params).fit(X)
+
+
+def load_index(path):
+  """
+  Loads an index written by its save() method.
+  """
+  with np.load(path) as data:
+    state = {key: data[key] for key in data.files}
+  kind = str(state.pop('kind'))
+  if kind not in INDEX_TYPES:
+    raise ValueError('Invalid index "%s"' % kind)
+  return INDEX_TYPES[kind]().set_state(state)
+
+
+def recall_at_k(idx, exact_idx):
+  """
+  Fraction of the exact k nearest neighbors (e.g. from
+  KNN.compute_L2_distances_vectorized or KNN.kneighbors without an index)
+  that the approximate search also returned.
+
+  Inputs:
+  - idx: Array of shape (num_test, k) of approximate neighbor indices.
+  - exact_idx: Array of shape (num_test, k) of exact neighbor indices.
+  """
+  hits = (idx[:, :, np.newaxis] == exact_idx[:, np.newaxis, :]).any(axis=1)
+  return np.mean(hits)
@@ -0,0 +1,249 @@
+import numpy as np
+
+"""
+Vectorized distance metrics for the KNN classifier.
+
+Every metric is fitted once on the training data (precomputing norms,
+whitening, ...) and then computes the distances between a block of test
+points and a contiguous tile of training points, so that all metrics share
+the memory-bounded tiling in nndl.knn. Metrics are looked up by name in
+METRICS.
+
+The training data may be a numpy array or any array-like whose slices are
+numpy arrays, such as nndl.knn_storage.CompactStorage.
+"""
+
+
+class Metric(object):
+  """
+  Base class for the metrics in METRICS.
+
+  Subclasses implement tile(), and may rank by a cheaper monotone surrogate
+  of the distance (e.g. squared L2) that finalize() converts back.
+  """
+
+  def __init__(self, X_train, dtype=None):
+    """
+    Inputs:
+    - X_train: A numpy array of shape (num_train, D).
+    - dtype: Floating point type for the computation; defaults to the type
+      of X_train promoted to at least float32.
+    """
+    if dtype is None:
+      dtype = np.result_type(X_train.dtype, np.float32)
+    self.dtype = np.dtype(dtype)
+    self.X_train = X_train
+    self.num_train = X_train.shape[0]
+
+  def query(self, X):
+    """
+    Converts test points into the form tile() expects.
+    """
+    return X.astype(self.dtype, copy=False)
+
+  def train_tile(self, start, end):
+    return self.X_train[start:end].astype(self.dtype, copy=False)
+
+  def train_squared_norms(self, chunk=4096):
+    """
+    Squared L2 norms of the training points, computed in chunks so that no
+    converted copy of the whole training set is made.
+    """
+    return np.concatenate([
+        np.sum(np.square(self.train_tile(start, start + chunk)), axis=1)
+        for start in range(0, self.num_train, chunk)])
+
+  def tile(self, X_block, start, end):
+    """
+    Returns the (B, end - start) distances between the (converted) test
+    points X_block and training points start, ..., end - 1.
+    """
+    raise NotImplementedError
+
+  def paired(self, X, Y):
+    """
+    Returns the (B, m) final distances between each converted test point
+    X[i] and its own m training points Y[i], for Y of shape (B, m, D). Used
+    to re-rank candidates found on compact data.
+    """
+    raise NotImplementedError
+
+  def finalize(self, d):
+    return d
+
+  def bytes_per_pair(self):
+    """
+    Approximate bytes of temporaries per (test, train) pair in tile() and
+    the top-k merge.
+    """
+    return 3 * self.dtype.itemsize + 8
+
+  def bytes_per_row(self):
+    """
+    Bytes per training row of the converted copy train_tile() makes; zero
+    when the training data is already stored in self.dtype.
+    """
+    if self.X_train.dtype == self.dtype:
+      return 0
+    return self.X_train.shape[1] * self.dtype.itemsize
+
+
+class SquaredL2(Metric):
+
+  def __init__(self, X_train, dtype=None):
+    super(SquaredL2, self).__init__(X_train, dtype)
+    self.train_squared = self.train_squared_norms()
+
+  def tile(self, X_block, start, end):
+    d = np.dot(X_block, self.train_tile(start, end).T)
+    d *= -2
+    d += np.sum(np.square(X_block), axis=1)[:, np.newaxis]
+    d += self.train_squared[start:end]
+    return d
+
+  def finalize(self, d):
+    return np.maximum(d, 0)
+
+  def paired(self, X, Y):
+    diff = Y.astype(self.dtype) - X[:, np.newaxis, :]
+    return np.einsum('ijk,ijk->ij', diff, diff)
+
+
+class L2(SquaredL2):
+
+  # Squared distances are ranked and only the survivors take the sqrt.
+  def finalize(self, d):
+    return np.sqrt(np.maximum(d, 0))
+
+  def paired(self, X, Y):
+    return np.sqrt(super(L2, self).paired(X, Y))
+
+
+class Cosine(Metric):
+  """
+  Cosine distance, 1 - cos(x, y).
+  """
+
+  def __init__(self, X_train, dtype=None):
+    super(Cosine, self).__init__(X_train, dtype)
+    norms = np.sqrt(self.train_squared_norms())
+    self.train_inv_norms = 1.0 / np.maximum(norms, 1e-12)
+
+  def tile(self, X_block, start, end):
+    norms = np.sqrt(np.sum(np.square(X_block), axis=1))
+    d = np.dot(X_block, self.train_tile(start, end).T)
+    d *= (1.0 / np.maximum(norms, 1e-12))[:, np.newaxis]
+    d *= self.train_inv_norms[start:end]
+    np.subtract(1, d, out=d)
+    return d
+
+  def paired(self, X, Y):
+    Y = Y.astype(self.dtype, copy=False)
+    d = np.einsum('ijk,ik->ij', Y, X)
+    d /= np.maximum(np.sqrt(np.einsum('ijk,ijk->ij', Y, Y)), 1e-12)
+    d /= np.maximum(np.sqrt(np.sum(np.square(X), axis=1)), 1e-12)[:, np.newaxis]
+    return 1 - d
+
+
+class _Elementwise(Metric):
+  """
+  Metrics with no matrix-product form, evaluated by broadcasting
+  differences. The (rows, cols, D) difference tensor is built in chunks of
+  about chunk_bytes so that it stays in cache, which is several times faster
+  than broadcasting over a whole tile.
+  """
+
+  chunk_bytes = 2**20
+
+  def reduce(self, diff):
+    raise NotImplementedError
+
+  def tile(self, X_block, start, end):
+    X_tile = self.train_tile(start, end)
+    B, T, D = X_block.shape[0], X_tile.shape[0], X_tile.shape[1]
+    d = np.empty((B, T), dtype=self.dtype)
+    rows = min(B, 4)
+    cols = max(self.chunk_bytes // (rows * D * self.dtype.itemsize), 1)
+    for i in range(0, B, rows):
+      for j in range(0, T, cols):
+        diff = X_block[i:i + rows, np.newaxis, :] - X_tile[j:j + cols]
+        np.abs(diff, out=diff)
+        d[i:i + rows, j:j + cols] = self.reduce(diff)
+    return d
+
+  def paired(self, X, Y):
+    diff = Y.astype(self.dtype) - X[:, np.newaxis, :]
+    np.abs(diff, out=diff)
+    return self.reduce(diff)
+
+
+class L1(_Elementwise):
+
+  def reduce(self, diff):
+    return np.sum(diff, axis=2)
+
+
+class Linf(_Elementwise):
+
+  def reduce(self, diff):
+    return np.max(diff, axis=2)
+
+
+class Mahalanobis(L2):
+  """
+  Mahalanobis distance sqrt((x - y)^T VI (x - y)).
+
+  With VI = L L^T (Cholesky), this is the L2 distance between x L and y L,
+  so the whitened training set is computed once and then searched with the
+  L2 kernel.
+  """
+
+  def __init__(self, X_train, dtype=None, VI=None, reg=1e-6):
+    """
+    Inputs:
+    - X_train, dtype: See Metric.
+    - VI: Inverse covariance matrix of shape (D, D); defaults to the inverse
+      of the (regularized) covariance of X_train.
+    - reg: Ridge added to the covariance diagonal when VI is estimated.
+    """
+    if VI is None:
+      cov = np.cov(X_train, rowvar=False)
+      cov += reg * np.eye(cov.shape[0])
+      VI = np.linalg.inv(cov)
+    if dtype is None:
+      dtype = np.result_type(X_train.dtype, np.float32)
+    self.whitening = np.linalg.cholesky(VI).astype(dtype)
+    X_white = np.dot(np.asarray(X_train, dtype=dtype), self.whitening)
+    super(Mahalanobis, self).__init__(X_white, dtype)
+
+  def query(self, X):
+    return np.dot(X.astype(self.dtype, copy=False), self.whitening)
+
+  def paired(self, X, Y):
+    return super(Mahalanobis, self).paired(X, self.query(Y))
+
+
+METRICS = {
+  'l1': L1,
+  'l2': L2,
+  'sqeuclidean': SquaredL2,
+  'cosine': Cosine,
+  'linf': Linf,
+  'mahalanobis': Mahalanobis,
+}
+
+
+def get_metric(name, X_train, dtype=None, **params):
+  """
+  Fits the metric registered under name in METRICS to X_train.
+
+  Inputs:
+  - name: Metric name, e.g. 'l1', 'l2', 'cosine'.
+  - X_train: A numpy array of shape (num_train, D).
+  - dtype: Optional floating point type, e.g. np.float32.
+  - params: Extra keyword arguments for the metric (e.g. VI for
+    'mahalanobis').
+  """
+  if name not in METRICS:
+    raise ValueError('Invalid metric "%s"' % name)
+  return METRICS[name](X_train, dtype=dtype, **params)
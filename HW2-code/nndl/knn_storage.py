@@ -0,0 +1,144 @@
+import numpy as np
+
+"""
+Compact storage of the KNN training data.
+
+The training points are kept as float32, float16 or int8 codes, optionally
+after a PCA projection, so that neighbor searches stream a fraction of the
+bytes of the original float64 array. A CompactStorage looks like a read-only
+(num_train, num_dims) array to the metrics in nndl.knn_metrics: slicing it
+decodes the rows to float32, one tile at a time.
+"""
+
+
+def _top_components(A, num_components, rng, num_power_iters=2):
+  """
+  Top right singular vectors of A, as a (D, num_components) float32 array,
+  from a randomized range finder with a few power iterations. Much cheaper
+  than a full SVD when num_components is small compared to A's dimensions.
+  """
+  num_components = min(num_components, *A.shape)
+  size = min(num_components + 10, *A.shape)
+  Y = np.dot(A, rng.standard_normal((A.shape[1], size)))
+  for _ in range(num_power_iters):
+    Y = np.linalg.qr(Y)[0]
+    Y = np.dot(A, np.dot(A.T, Y))
+  Y = np.linalg.qr(Y)[0]
+  _, _, Vt = np.linalg.svd(np.dot(Y.T, A), full_matrices=False)
+  return Vt[:num_components].T.astype(np.float32)
+
+
+class CompactStorage(object):
+  """
+  Training data stored in reduced precision.
+
+  'int8' stores every dimension with its own scale and offset, so that its
+  observed range maps onto the 256 codes.
+  """
+
+  dtypes = ('float32', 'float16', 'int8')
+
+  def __init__(self, dtype='int8', num_components=None, sample_size=4096,
+               seed=None):
+    """
+    Inputs:
+    - dtype: Storage type, one of 'float32', 'float16' or 'int8'.
+    - num_components: If not None, the data is projected on its top
+      num_components principal components before being stored.
+    - sample_size: Number of training points the PCA is fitted on.
+    - seed: Seed for the PCA sample.
+    """
+    if dtype not in self.dtypes:
+      raise ValueError('Invalid storage dtype "%s"' % dtype)
+    self.dtype = np.dtype(dtype)
+    self.num_components = num_components
+    self.sample_size = sample_size
+    self.seed = seed
+    self.mean = None
+    self.components = None
+    self.scale = None
+    self.offset = None
+
+  def fit(self, X):
+    """
+    Fits the PCA and quantization ranges to X and encodes it.
+
+    Inputs:
+    - X: A numpy array of shape (num_train, D) containing training data; it
+      is read in chunks, so it may be an np.memmap.
+    """
+    N = X.shape[0]
+    chunk = max(2**24 // (X.shape[1] * 8), 1)
+
+    if self.num_components is not None:
+      rng = np.random.default_rng(self.seed)
+      sample = X[np.sort(rng.choice(N, min(N, self.sample_size),
+                                    replace=False))].astype(np.float64)
+      self.mean = np.mean(sample, axis=0)
+      sample -= self.mean
+      self.components = _top_components(sample, self.num_components, rng)
+      self.mean = self.mean.astype(np.float32)
+
+    num_dims = X.shape[1] if self.components is None else \
+        self.components.shape[1]
+    if self.dtype == np.int8:
+      lo = np.full(num_dims, np.inf, dtype=np.float32)
+      hi = np.full(num_dims, -np.inf, dtype=np.float32)
+      for start in range(0, N, chunk):
+        Z = self.transform(X[start:start + chunk])
+        lo = np.minimum(lo, np.min(Z, axis=0))
+        hi = np.maximum(hi, np.max(Z, axis=0))
+      self.scale = (hi - lo) / 255
+      self.scale[self.scale == 0] = 1
+      self.offset = lo + 128 * self.scale
+
+    self.codes = np.empty((N, num_dims), dtype=self.dtype)
+    for start in range(0, N, chunk):
+      self.codes[start:start + chunk] = \
+          self.encode(self.transform(X[start:start + chunk]))
+    return self
+
+  def transform(self, X):
+    """
+    Maps points from the original space to the stored space as float32
+    (PCA projection, without quantization). Test points are compared to the
+    stored codes in this form.
+    """
+    X = X.astype(np.float32)
+    if self.components is None:
+      return X
+    X -= self.mean
+    return np.dot(X, self.components)
+
+  def encode(self, Z):
+    if self.dtype != np.int8:
+      return Z.astype(self.dtype)
+    Z = (Z - self.offset) / self.scale
+    return np.clip(np.rint(Z), -128, 127).astype(np.int8)
+
+  def decode(self, codes):
+    Z = codes.astype(np.float32)
+    if self.dtype == np.int8:
+      Z *= self.scale
+      Z += self.offset
+    return Z
+
+  @property
+  def shape(self):
+    return self.codes.shape
+
+  @property
+  def nbytes(self):
+    return self.codes.nbytes
+
+  def __len__(self):
+    return self.codes.shape[0]
+
+  def __getitem__(self, key):
+    if self.dtype == np.float32:
+      return self.codes[key]
+    return self.decode(self.codes[key])
+
+  def __array__(self, dtype=None, copy=None):
+    Z = self[:]
+    return Z if dtype is None else Z.astype(dtype, copy=False)
@@ -0,0 +1,203 @@
+import time
+
+import numpy as np
+
+from nndl.svm import SVM, svm_hinge_loss
+from nndl.softmax import softmax_cross_entropy
+
+"""
+Minibatch streaming training for the linear classifiers (SVM and Softmax).
+
+Unlike SVM.train and Softmax.train, nothing here needs the full training set
+in memory: data is consumed as a stream of (X_batch, y_batch) minibatches,
+which can come from a memory-mapped array (see iterate_minibatches) or from
+any generator.
+"""
+
+
+def iterate_minibatches(X, y, batch_size=200, num_epochs=1, shuffle=True,
+                        block_size=None, seed=None):
+  """
+  Yields (X_batch, y_batch) minibatches from X and y, which may be
+  np.memmap arrays (e.g. opened with np.load(..., mmap_mode='r')).
+
+  To keep reads sequential, the data is split into contiguous blocks of
+  block_size rows. Blocks are visited in random order and each block is
+  read into memory once and shuffled there, so only one block is ever
+  resident at a time.
+
+  Inputs:
+  - X: Array of shape (N, D).
+  - y: Array of shape (N,).
+  - batch_size: Number of examples per minibatch.
+  - num_epochs: Number of passes over the data; None loops forever.
+  - shuffle: If False, rows are produced in storage order.
+  - block_size: Rows per contiguous read; defaults to 50 minibatches.
+  - seed: Seed for the shuffling RNG.
+  """
+  N = X.shape[0]
+  if block_size is None:
+    block_size = 50 * batch_size
+  block_size = max(block_size, batch_size)
+  rng = np.random.default_rng(seed)
+  starts = np.arange(0, N, block_size)
+
+  epoch = 0
+  while num_epochs is None or epoch < num_epochs:
+    order = rng.permutation(starts) if shuffle else starts
+    for start in order:
+      X_block = np.asarray(X[start:start + block_size])
+      y_block = np.asarray(y[start:start + block_size])
+      if shuffle:
+        idx = rng.permutation(X_block.shape[0])
+        X_block, y_block = X_block[idx], y_block[idx]
+      for i in range(0, X_block.shape[0], batch_size):
+        yield X_block[i:i + batch_size], y_block[i:i + batch_size]
+    epoch += 1
+
+
+def step_decay(learning_rate, decay=0.95, every=1000):
+  """
+  Returns a schedule that multiplies learning_rate by decay every `every`
+  iterations.
+  """
+  return lambda it: learning_rate * decay ** (it // every)
+
+
+def inverse_time_decay(learning_rate, decay=1e-3):
+  """
+  Returns the schedule learning_rate / (1 + decay * it).
+  """
+  return lambda it: learning_rate / (1.0 + decay * it)
+
+
+def evaluate_stream(model, batches):
+  """
+  Computes the average loss and accuracy of model over a stream of
+  minibatches without holding more than one of them in memory.
+
+  Inputs:
+  - model: An SVM or Softmax instance.
+  - batches: Iterable of (X_batch, y_batch).
+
+  Returns a tuple of:
+  - loss: Example-weighted average loss
+  - acc: Fraction of correctly classified examples
+  """
+  # Only the loss is needed, so the scores are computed once and the loss
+  # kernels skip the gradient.
+  loss_fn = svm_hinge_loss if isinstance(model, SVM) else softmax_cross_entropy
+  total_loss, total_correct, total = 0.0, 0, 0
+  for X_batch, y_batch in batches:
+    n = X_batch.shape[0]
+    scores = np.dot(X_batch, model.W.T)
+    total_loss += loss_fn(scores, y_batch, grad=False)[0] * n
+    total_correct += np.sum(np.argmax(scores, axis=1) == y_batch)
+    total += n
+  return total_loss / max(total, 1), total_correct / max(total, 1)
+
+
+def train_streaming(model, batches, learning_rate=1e-3, num_iters=None,
+                    num_classes=None, warm_start=True, val_batches=None,
+                    eval_every=100, patience=None, verbose=False):
+  """
+  Train a linear classifier with stochastic gradient descent on a stream of
+  minibatches.
+
+  Inputs:
+  - model: An SVM or Softmax instance; model.W is updated in place.
+  - batches: Either a tuple (X, y) of (possibly memory-mapped) arrays, which
+    is streamed with iterate_minibatches for one epoch, or any iterable of
+    (X_batch, y_batch) minibatches.
+  - learning_rate: Scalar learning rate, or a function mapping the iteration
+    number to a learning rate (see step_decay and inverse_time_decay).
+  - num_iters: Maximum number of steps; None runs until the stream ends.
+  - num_classes: Number of classes C, only needed when the weights have to
+    be (re)initialized. Defaults to model.W.shape[0].
+  - warm_start: If True and model.W already has shape (C, D), training
+    continues from the current weights instead of reinitializing them.
+  - val_batches: Optional held-out data, either a tuple (X_val, y_val) or a
+    function returning a fresh iterable of (X_batch, y_batch) minibatches.
+  - eval_every: Evaluate on val_batches every eval_every iterations.
+  - patience: If not None, stop after this many evaluations without an
+    improvement of the held-out loss and restore the best weights.
+  - verbose: (boolean) If true, print progress during optimization.
+
+  Returns a dictionary with:
+  - loss_history: Training loss at each iteration.
+  - val_loss_history, val_acc_history: Held-out loss and accuracy at each
+    evaluation.
+  - samples_per_sec: Training throughput, excluding evaluation time.
+  - num_iters: Number of steps actually taken.
+  """
+  if isinstance(batches, tuple):
+    batches = iterate_minibatches(*batches)
+  if isinstance(val_batches, tuple):
+    X_val, y_val = val_batches
+    val_batches = lambda: iterate_minibatches(X_val, y_val, batch_size=1000,
+                                              shuffle=False)
+  schedule = learning_rate if callable(learning_rate) else \
+      (lambda it: learning_rate)
+  if num_classes is None:
+    num_classes = model.W.shape[0]
+
+  loss_history = []
+  val_loss_history = []
+  val_acc_history = []
+  best_val_loss, best_W, bad_evals = np.inf, None, 0
+  num_samples, train_time = 0, 0.0
+
+  it = 0
+  tic = time.time()
+  for X_batch, y_batch in batches:
+    if num_iters is not None and it >= num_iters:
+      break
+
+    if it == 0:
+      dims = [num_classes, X_batch.shape[1]]
+      if not warm_start or list(model.W.shape) != dims:
+        model.init_weights(dims=dims)
+
+    loss, grad = model.fast_loss_and_grad(X_batch, y_batch)
+    model.W -= schedule(it) * grad
+    loss_history.append(loss)
+    num_samples += X_batch.shape[0]
+    it += 1
+
+    if verbose and it % 100 == 0:
+      print('iteration {}: loss {}'.format(it, loss))
+
+    if val_batches is not None and it % eval_every == 0:
+      train_time += time.time() - tic
+      val_loss, val_acc = evaluate_stream(model, val_batches())
+      val_loss_history.append(val_loss)
+      val_acc_history.append(val_acc)
+      if verbose:
+        print('iteration {}: val loss {}, val acc {}'.format(it, val_loss, val_acc))
+
+      if val_loss < best_val_loss:
+        best_val_loss, best_W, bad_evals = val_loss, model.W.copy(), 0
+      else:
+        bad_evals += 1
+        if patience is not None and bad_evals >= patience:
+          if verbose:
+            print('early stopping at iteration {}'.format(it))
+          if best_W is not None:
+            model.W = best_W
+          tic = time.time()
+          break
+      tic = time.time()
+
+  train_time += time.time() - tic
+  samples_per_sec = num_samples / train_time if train_time > 0 else 0.0
+  if verbose:
+    print('{} samples in {:.2f}s ({:.0f} samples/sec)'.format(
+        num_samples, train_time, samples_per_sec))
+
+  return {
+    'loss_history': loss_history,
+    'val_loss_history': val_loss_history,
+    'val_acc_history': val_acc_history,
+    'samples_per_sec': samples_per_sec,
+    'num_iters': it,
+  }
@@ -1,5 +1,71 @@
 import numpy as np
 
+def softmax_cross_entropy(x, y, label_smoothing=0.0, class_weights=None,
+                          inplace=False, grad=True):
+  """
+  Fused log-softmax / cross-entropy loss and gradient.
+
+  The max-shift, exponentiation, normalization and the subtraction of the
+  targets are all done on a single (N, C) buffer, which is returned as the
+  gradient. The dtype of x (e.g. float32) is preserved.
+
+  Inputs:
+  - x: Scores, of shape (N, C) where x[i, j] is the score for the jth class
+    for the ith input.
+  - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
+    0 <= y[i] < C
+  - label_smoothing: Scalar in [0, 1). The target for each input is
+    (1 - label_smoothing) on the true class plus label_smoothing / C on
+    every class.
+  - class_weights: Optional array of shape (C,). Each input's loss is
+    weighted by class_weights[y[i]] and the total is normalized by the sum
+    of those weights instead of N.
+  - inplace: If True, x is overwritten and reused as the gradient buffer.
+  - grad: If False, skip the gradient and return None in its place.
+
+  Returns a tuple of:
+  - loss: Scalar giving the loss
+  - dx: Gradient of the loss with respect to x
+  """
+  N, C = x.shape
+  rows = np.arange(N)
+  dx = x if inplace else x.copy()
+
+  dx -= np.max(dx, axis=1, keepdims=True)
+  # Per-example cross-entropy against the (smoothed) target distribution,
+  # written in terms of the shifted scores before they are exponentiated.
+  losses = -(1.0 - label_smoothing) * dx[rows, y]
+  if label_smoothing:
+    losses -= label_smoothing / C * np.sum(dx, axis=1)
+
+  np.exp(dx, out=dx)
+  sums = np.sum(dx, axis=1)
+  losses += np.log(sums)
+
+  if not grad:
+    if class_weights is None:
+      return float(np.sum(losses) / N), None
+    weights = np.asarray(class_weights)[y]
+    return float(np.dot(weights / np.sum(weights), losses)), None
+
+  dx /= sums[:, np.newaxis]
+
+  if label_smoothing:
+    dx -= label_smoothing / C
+  dx[rows, y] -= 1.0 - label_smoothing
+
+  if class_weights is None:
+    loss = np.sum(losses) / N
+    dx /= N
+  else:
+    weights = np.asarray(class_weights)[y]
+    weights = weights / np.sum(weights)
+    loss = np.dot(weights, losses)
+    dx *= weights.astype(dx.dtype)[:, np.newaxis]
+
+  return float(loss), dx
+
+
 class Softmax(object):
 
   def __init__(self, dims=[10, 3073]):
@@ -106,8 +172,11 @@ class Softmax(object):
     """
     sample a few random elements and only return numerical
     in these dimensions.
+
+    Returns the array of the num_checks relative errors.
     """
   
+    rel_errors = np.zeros(num_checks)
     for i in np.arange(num_checks):
       ix = tuple([np.random.randint(m) for m in self.W.shape])
   
@@ -122,6 +191,8 @@ class Softmax(object):
       grad_analytic = your_grad[ix]
       rel_error = abs(grad_numerical - grad_analytic) / (abs(grad_numerical) + abs(grad_analytic))
       print('numerical: %f analytic: %f, relative error: %e' % (grad_numerical, grad_analytic, rel_error))
+      rel_errors[i] = rel_error
+    return rel_errors
 
   def fast_loss_and_grad(self, X, y):
     """
@@ -135,21 +206,12 @@ class Softmax(object):
     # YOUR CODE HERE:
 	#   Calculate the softmax loss and gradient WITHOUT any for loops.
     # ================================================================ #
-    n = len(X)
-    num_classes = len(self.W)
-    
     Wx = np.dot(X, self.W.T)
-    Wx -= np.max(Wx, axis=1).reshape(-1, 1)
-    
-    Wx_exp = np.exp(Wx)
-    exp_sum = np.sum(Wx_exp, axis=1)
-    
-    loss = -Wx[range(n), y] + np.log(np.sum(Wx_exp, axis=1))
-    loss = np.sum(loss) / n
     
-    grad = Wx_exp / exp_sum.reshape(-1, 1)
-    grad[range(n), y] -= 1
-    grad = np.dot(grad.T, X) / n
+    # The score matrix is a temporary, so the fused kernel can reuse it as
+    # the gradient buffer (already normalized by the number of examples).
+    loss, dWx = softmax_cross_entropy(Wx, y, inplace=True)
+    grad = np.dot(dWx.T, X)
     
     # ================================================================ #
     # END YOUR CODE HERE
@@ -158,7 +220,7 @@ class Softmax(object):
     return loss, grad
 
   def train(self, X, y, learning_rate=1e-3, num_iters=100,
-            batch_size=200, verbose=False):
+            batch_size=200, verbose=False, warm_start=False):
     """
     Train this linear classifier using stochastic gradient descent.
 
@@ -171,6 +233,9 @@ class Softmax(object):
     - num_iters: (integer) number of steps to take when optimizing
     - batch_size: (integer) number of training examples to use at each step.
     - verbose: (boolean) If true, print progress during optimization.
+    - warm_start: (boolean) If true and self.W already has the right shape,
+      continue from the current weights instead of reinitializing them. For
+      data that does not fit in memory, see nndl.linear_train.
 
     Outputs:
     A list containing the value of the loss function at each training iteration.
@@ -178,7 +243,9 @@ class Softmax(object):
     num_train, dim = X.shape
     num_classes = np.max(y) + 1 # assume y takes values 0...K-1 where K is number of classes
 
-    self.init_weights(dims=[np.max(y) + 1, X.shape[1]])	# initializes the weights of self.W
+    dims = [np.max(y) + 1, X.shape[1]]
+    if not warm_start or list(self.W.shape) != dims:
+      self.init_weights(dims=dims)	# initializes the weights of self.W
 
     # Run stochastic gradient descent to optimize W
     loss_history = []
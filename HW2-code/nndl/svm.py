@@ -4,6 +4,58 @@ import pdb
 """
 This code was based off of code from cs231n at Stanford University, and modified for ECE C147/C247 at UCLA.
 """
+
+def svm_hinge_loss(x, y, delta=1.0, grad=True, sparse=False):
+  """
+  Vectorized multiclass SVM (hinge) loss and gradient.
+
+  The margins are computed once into a single (N, C) buffer, clamped in
+  place, and the same buffer is turned into the gradient.
+
+  Inputs:
+  - x: Scores, of shape (N, C) where x[i, j] is the score for the jth class
+    for the ith input.
+  - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
+    0 <= y[i] < C
+  - delta: Scalar margin.
+  - grad: If False, skip the gradient and return None in its place.
+  - sparse: If True, return the gradient as a scipy.sparse CSR matrix whose
+    only nonzeros are the violating margins and the correct-class entries.
+
+  Returns a tuple of:
+  - loss: Scalar giving the loss
+  - dx: Gradient of the loss with respect to x
+  """
+  N = x.shape[0]
+  rows = np.arange(N)
+
+  margins = x - x[rows, y][:, np.newaxis]
+  margins += delta
+  margins[rows, y] = 0
+  np.maximum(margins, 0, out=margins)
+  loss = np.sum(margins) / N
+
+  if not grad:
+    return loss, None
+
+  if sparse:
+    from scipy.sparse import csr_matrix
+    viol_rows, viol_cols = np.nonzero(margins)
+    num_pos = np.bincount(viol_rows, minlength=N)
+    data = np.concatenate((np.ones(viol_rows.size), -num_pos)) / N
+    dx = csr_matrix((data.astype(x.dtype, copy=False),
+                     (np.concatenate((viol_rows, rows)),
+                      np.concatenate((viol_cols, y)))),
+                    shape=x.shape)
+    return loss, dx
+
+  # Margins are non-negative here, so sign() gives the 0/1 indicator.
+  dx = np.sign(margins, out=margins)
+  dx[rows, y] = -np.sum(dx, axis=1)
+  dx /= N
+  return loss, dx
+
+
 class SVM(object):
 
   def __init__(self, dims=[10, 3073]):
@@ -32,12 +84,6 @@ class SVM(object):
     - loss as single float
     """
   
-    # compute the loss and the gradient
-    num_classes = self.W.shape[0]
-    num_train = X.shape[0]
-    loss = 0.0
-
-    for i in np.arange(num_train):
     # ================================================================ #
     # YOUR CODE HERE:
 	  #   Calculate the normalized SVM loss, and store it as 'loss'.
@@ -45,18 +91,8 @@ class SVM(object):
     #   set margins, and then normalize the loss by the number of 
 	  #	  training examples.)
     # ================================================================ #
-      curr_x = X[i]
-      curr_y = y[i]
-      x_i = np.dot(curr_x, self.W.T)
-        
-      curr_loss = 1 - x_i[curr_y] + x_i
-      curr_loss[curr_y] = 0
-      curr_loss = np.maximum(0, curr_loss)
-      curr_loss = np.sum(curr_loss)
-      
-      loss += curr_loss
-        
-    loss /= num_train
+
+    loss, _ = svm_hinge_loss(np.dot(X, self.W.T), y, grad=False)
       
     # ================================================================ #
     # END YOUR CODE HERE
@@ -72,52 +108,30 @@ class SVM(object):
 		the gradient of the loss with respect to W.
 	"""
   
-    # compute the loss and the gradient
-    num_classes = self.W.shape[0]
-    num_train = X.shape[0]
-    loss = 0.0
-    grad = np.zeros_like(self.W)
-
-    for i in np.arange(num_train):
     # ================================================================ #
     # YOUR CODE HERE:
 	#   Calculate the SVM loss and the gradient.  Store the gradient in
     #   the variable grad.
     # ================================================================ #
-      
-      curr_x = X[i]
-      curr_y = y[i]
-      x_i = np.dot(curr_x, self.W.T)
-        
-      curr_loss = 1 - x_i[curr_y] + x_i
-      curr_loss[curr_y] = 0
-      curr_loss = np.maximum(0, curr_loss)
-    
-      count = 0
-      for j in range(num_classes):
-            if curr_loss[j] > 0:
-                grad[j] += X[i]
-                grad[curr_y] -= X[i]
-            
-      curr_loss = np.sum(curr_loss)
-      
-      loss += curr_loss
+
+    loss, dscores = svm_hinge_loss(np.dot(X, self.W.T), y)
+    grad = np.dot(dscores.T, X)
 
     # ================================================================ #
     # END YOUR CODE HERE
     # ================================================================ #
 
-    loss /= num_train
-    grad /= num_train
-
     return loss, grad
 
   def grad_check_sparse(self, X, y, your_grad, num_checks=10, h=1e-5):
     """
     sample a few random elements and only return numerical
     in these dimensions.
+
+    Returns the array of the num_checks relative errors.
     """
   
+    rel_errors = np.zeros(num_checks)
     for i in np.arange(num_checks):
       ix = tuple([np.random.randint(m) for m in self.W.shape])
 
@@ -132,45 +146,27 @@ class SVM(object):
       grad_analytic = your_grad[ix]
       rel_error = abs(grad_numerical - grad_analytic) / (abs(grad_numerical) + abs(grad_analytic))
       print('numerical: %f analytic: %f, relative error: %e' % (grad_numerical, grad_analytic, rel_error))
+      rel_errors[i] = rel_error
+    return rel_errors
 
-  def fast_loss_and_grad(self, X, y):
+  def fast_loss_and_grad(self, X, y, sparse=False):
     """
     A vectorized implementation of loss_and_grad. It shares the same
 	inputs and ouptuts as loss_and_grad.
+
+    If sparse is True the score gradient is kept as a sparse matrix holding
+    only the violating margins, which is cheaper once most margins are met.
     """
     loss = 0.0
     grad = np.zeros(self.W.shape) # initialize the gradient as zero
   
     # ================================================================ #
     # YOUR CODE HERE:
-	#   Calculate the SVM loss WITHOUT any for loops.
-    # ================================================================ #
-    num_classes = self.W.shape[0]
-    num_train = X.shape[0]
-    
-    x_i = np.dot(X, self.W.T)
-    
-    x_i = x_i + 1 - x_i[range(num_train), y].reshape((-1, 1))
-    x_i[range(num_train), y] = 0
-    x_i = np.maximum(0, x_i)
-    
-    loss = np.sum(x_i) / num_train
-    
+	#   Calculate the SVM loss and grad WITHOUT any for loops.
     # ================================================================ #
-    # END YOUR CODE HERE
-    # ================================================================ #
-
-
 
-	# ================================================================ #
-    # YOUR CODE HERE:
-	#   Calculate the SVM grad WITHOUT any for loops.
-    # ================================================================ #
-    
-    x_i[x_i > 0] = 1
-    x_i[range(num_train), y] = -1 * np.sum(x_i, axis=1)
-    
-    grad = np.dot(x_i.T, X) / num_train
+    loss, dscores = svm_hinge_loss(np.dot(X, self.W.T), y, sparse=sparse)
+    grad = dscores.T.dot(X)
     
     # ================================================================ #
     # END YOUR CODE HERE
@@ -179,7 +175,7 @@ class SVM(object):
     return loss, grad
 
   def train(self, X, y, learning_rate=1e-3, num_iters=100,
-            batch_size=200, verbose=False):
+            batch_size=200, verbose=False, warm_start=False):
     """
     Train this linear classifier using stochastic gradient descent.
 
@@ -192,6 +188,9 @@ class SVM(object):
     - num_iters: (integer) number of steps to take when optimizing
     - batch_size: (integer) number of training examples to use at each step.
     - verbose: (boolean) If true, print progress during optimization.
+    - warm_start: (boolean) If true and self.W already has the right shape,
+      continue from the current weights instead of reinitializing them. For
+      data that does not fit in memory, see nndl.linear_train.
 
     Outputs:
     A list containing the value of the loss function at each training iteration.
@@ -199,7 +198,9 @@ class SVM(object):
     num_train, dim = X.shape
     num_classes = np.max(y) + 1 # assume y takes values 0...K-1 where K is number of classes
 
-    self.init_weights(dims=[np.max(y) + 1, X.shape[1]])	# initializes the weights of self.W
+    dims = [np.max(y) + 1, X.shape[1]]
+    if not warm_start or list(self.W.shape) != dims:
+      self.init_weights(dims=dims)	# initializes the weights of self.W
 
     # Run stochastic gradient descent to optimize W
     loss_history = []
@@ -0,0 +1,105 @@
+from __future__ import print_function, division
+
+import numpy as np
+
+"""
+Preallocated copies of model parameters, used by Solver to track the best
+and the averaged weights without allocating new arrays during training.
+"""
+
+
+class ParamBuffer(object):
+    """
+    A copy of a dictionary of parameters held in one flat buffer per dtype.
+
+    The buffers are allocated once, when the ParamBuffer is created, and
+    later copies (copy_from) and averages (update_average) are written into
+    them in place. self.views maps every parameter name to an array view of
+    its slice of the buffer, so it can be used like a params dictionary.
+    With a path, the buffers are memory-mapped .npy files, so the copy
+    lives on disk and only takes memory while the OS caches it.
+    """
+
+    def __init__(self, params, path=None):
+        """
+        Inputs:
+        - params: Dictionary mapping names to numpy arrays; only the shapes
+          and dtypes are used.
+        - path: If not None, the buffers are stored in the files
+          '%s_%s.npy' % (path, dtype name).
+        """
+        self.path = path
+        self.buffers = {}
+        self.views = {}
+        self._scratch = {}
+
+        names_by_dtype = {}
+        for name in sorted(params):
+            names_by_dtype.setdefault(params[name].dtype, []).append(name)
+        for dtype, names in names_by_dtype.items():
+            size = sum(params[name].size for name in names)
+            if path is None:
+                buf = np.empty(size, dtype=dtype)
+            else:
+                buf = np.lib.format.open_memmap(
+                    '%s_%s.npy' % (path, dtype.name), mode='w+', dtype=dtype,
+                    shape=(size,))
+            self.buffers[dtype] = buf
+            offset = 0
+            for name in names:
+                shape = params[name].shape
+                self.views[name] = buf[offset:offset + params[name].size] \
+                    .reshape(shape)
+                offset += params[name].size
+
+    def copy_from(self, params):
+        """
+        Copies params into the buffers.
+        """
+        for name, view in self.views.items():
+            np.copyto(view, params[name])
+        self.flush()
+
+    def copy_to(self, params):
+        """
+        Copies the buffers into the arrays of params, in place where the
+        shapes and dtypes match.
+        """
+        for name, view in self.views.items():
+            w = params.get(name)
+            if isinstance(w, np.ndarray) and w.shape == view.shape and \
+                    w.dtype == view.dtype and w.flags.writeable:
+                np.copyto(w, view)
+            else:
+                params[name] = np.array(view)
+
+    def update_average(self, params, weight):
+        """
+        Replaces every buffered value v by (1 - weight) * v + weight * p,
+        where p is the matching entry of params, in place and without
+        allocating temporaries.
+        """
+        for name, view in self.views.items():
+            scratch = self._scratch_view(view)
+            np.multiply(params[name], weight, out=scratch)
+            view *= 1 - weight
+            view += scratch
+
+    def _scratch_view(self, view):
+        dtype = view.dtype
+        if dtype not in self._scratch:
+            largest = max(v.size for v in self.views.values() if v.dtype == dtype)
+            self._scratch[dtype] = np.empty(largest, dtype=dtype)
+        return self._scratch[dtype][:view.size].reshape(view.shape)
+
+    def flush(self):
+        """
+        Writes memory-mapped buffers back to their files.
+        """
+        if self.path is not None:
+            for buf in self.buffers.values():
+                buf.flush()
+
+    @property
+    def nbytes(self):
+        return sum(buf.nbytes for buf in self.buffers.values())
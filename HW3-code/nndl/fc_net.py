@@ -246,7 +246,7 @@ class FullyConnectedNet(object):
       self.dropout_param['mode'] = mode   
     if self.use_batchnorm:
       for bn_param in self.bn_params:
-        bn_param[mode] = mode
+        bn_param['mode'] = mode
 
     scores = None
     
@@ -298,3 +298,19 @@ class FullyConnectedNet(object):
     # END YOUR CODE HERE
     # ================================================================ #
     return loss, grads
+
+
+  def scores(self, X):
+    """
+    Test-time classification scores, equal to self.loss(X), computed without
+    keeping the caches of the layers so that each intermediate activation
+    can be freed as soon as the next one is computed. Used by Solver to
+    check accuracy.
+    """
+    scores = X.astype(self.dtype)
+    for i in range(self.num_layers):
+      scores = affine_forward(scores, self.params["W" + str(i + 1)],
+                              self.params["b" + str(i + 1)])[0]
+      if i < self.num_layers - 1:
+        scores = relu_forward(scores)[0]
+    return scores
@@ -1,6 +1,8 @@
 import numpy as np
 import matplotlib.pyplot as plt
 
+from .layers import softmax_cross_entropy
+
 """ 
 This code was originally written for CS 231n at Stanford University
 (cs231n.stanford.edu).  It has been modified in various areas for use in the
@@ -119,14 +121,12 @@ class TwoLayerNet(object):
 
     # scores is num_examples by num_classes
     
-    scores -= np.max(scores, axis=1).reshape((-1, 1))
-    scores_exp = np.exp(scores)
-    sum_scores_exp = np.sum(scores_exp, axis=1)
-    
-    loss = -scores[range(N), y] + np.log(sum_scores_exp)
+    # scores is not needed after this point, so the fused kernel overwrites
+    # it with the gradient of the data loss.
+    data_loss, grad = softmax_cross_entropy(scores, y, inplace=True)
     reg_loss = 0.5 * reg * (np.linalg.norm(W1, "fro") ** 2 + np.linalg.norm(W2, "fro") ** 2)
     
-    loss = np.sum(loss) / N + reg_loss
+    loss = data_loss + reg_loss
     
     # ================================================================ #
     # END YOUR CODE HERE
@@ -142,10 +142,6 @@ class TwoLayerNet(object):
 	# 	W1, and be of the same size as W1.
 	# ================================================================ #
 
-    grad = scores_exp / sum_scores_exp.reshape((-1, 1))
-    grad[range(N), y] -= 1
-    grad /= N
-    
     grads["W2"] = np.dot(grad.T, out1) + reg * W2
     grads["b2"] = np.sum(grad.T, axis=1)
     
@@ -1,61 +1,315 @@
 from __future__ import print_function
-from past.builtins import xrange
+import functools
+import hashlib
+import mmap
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 
 import matplotlib
 import numpy as np
-from scipy.ndimage import uniform_filter
 
 
-def extract_features(imgs, feature_fns, verbose=False):
+def batched(batch_fn):
+  """
+  Decorator declaring that batch_fn(imgs, *args, **kwargs) computes the
+  features of a whole N x H x W x C batch, as an (N, F) array, with the same
+  result as the decorated single-image function on each image.
+  extract_features then calls batch_fn on batches of images, also when the
+  single-image function is wrapped in functools.partial.
+  """
+  def decorator(feature_fn):
+    feature_fn.batched = batch_fn
+    return feature_fn
+  return decorator
+
+
+def _batch_fn(feature_fn):
+  """
+  Returns the batch version of feature_fn declared with @batched, or None.
+  """
+  if isinstance(feature_fn, functools.partial):
+    batch_fn = getattr(feature_fn.func, 'batched', None)
+    if batch_fn is None:
+      return None
+    return functools.partial(batch_fn, *feature_fn.args, **feature_fn.keywords)
+  return getattr(feature_fn, 'batched', None)
+
+
+def _fn_config(feature_fn):
+  """
+  A description of feature_fn for the feature cache key: its code, defaults,
+  closure and bound arguments, plus the scalar globals its code reads (e.g.
+  a notebook-level num_color_bins used by a lambda).
+  """
+  if isinstance(feature_fn, functools.partial):
+    return (_fn_config(feature_fn.func), repr(feature_fn.args),
+            repr(sorted(feature_fn.keywords.items())))
+  code = getattr(feature_fn, '__code__', None)
+  if code is None:
+    return repr(feature_fn)
+  scalars = (bool, int, float, str)
+  fn_globals = getattr(feature_fn, '__globals__', {})
+  used_globals = [(name, fn_globals[name]) for name in code.co_names
+                  if isinstance(fn_globals.get(name), scalars)]
+  closure = [cell.cell_contents for cell in feature_fn.__closure__ or ()]
+  return (feature_fn.__module__, feature_fn.__qualname__, code.co_code,
+          repr(code.co_consts), repr(feature_fn.__defaults__),
+          repr(feature_fn.__kwdefaults__), repr(closure), repr(used_globals))
+
+
+def features_cache_key(imgs, feature_fns, chunk_bytes=2**24):
+  """
+  Hex digest identifying the features of imgs under feature_fns. The image
+  data is hashed in chunks, so imgs may be an np.memmap.
+  """
+  h = hashlib.sha1()
+  h.update(repr((imgs.shape, imgs.dtype.str)).encode())
+  rows = max(chunk_bytes // max(imgs[0].nbytes, 1), 1) if len(imgs) else 1
+  for start in range(0, imgs.shape[0], rows):
+    h.update(np.ascontiguousarray(imgs[start:start + rows]).data)
+  for feature_fn in feature_fns:
+    h.update(repr(_fn_config(feature_fn)).encode())
+  return h.hexdigest()
+
+
+def _extract_block(imgs, feature_fns, feature_dims, out):
+  """
+  Writes the features of the batch imgs into the rows of out.
+  """
+  idx = 0
+  for feature_fn, feature_dim in zip(feature_fns, feature_dims):
+    next_idx = idx + feature_dim
+    batch_fn = _batch_fn(feature_fn)
+    if batch_fn is not None:
+      out[:, idx:next_idx] = batch_fn(imgs)
+    else:
+      for i in range(imgs.shape[0]):
+        out[i, idx:next_idx] = feature_fn(imgs[i].squeeze())
+    idx = next_idx
+
+
+def _feature_dims(img, feature_fns):
+  """
+  Lengths of the feature vectors feature_fns compute, from a single image.
+  """
+  feature_dims = []
+  for feature_fn in feature_fns:
+    feats = feature_fn(img.squeeze())
+    assert len(feats.shape) == 1, 'Feature functions must be one-dimensional'
+    feature_dims.append(feats.size)
+  return feature_dims
+
+
+# (imgs, feature_fns, feature_dims, out) shared with forked workers; see
+# extract_features.
+_EXTRACT_JOB = None
+
+
+def _extract_shard(start, end):
+  imgs, feature_fns, feature_dims, out = _EXTRACT_JOB
+  _extract_block(imgs[start:end], feature_fns, feature_dims, out[start:end])
+  return end - start
+
+
+def extract_features(imgs, feature_fns, verbose=False, num_workers=None,
+                     batch_size=1000, cache_dir=None):
   """
   Given pixel data for images and several feature functions that can operate on
   single images, apply all feature functions to all images, concatenating the
   feature vectors for each image and storing the features for all images in
   a single matrix.
 
+  Feature functions declared with @batched (such as hog_feature and
+  color_histogram_hsv, also inside functools.partial) are applied to whole
+  batches of images. The batches are sharded across forked worker
+  processes, which write directly into a shared output array.
+
   Inputs:
   - imgs: N x H X W X C array of pixel data for N images.
   - feature_fns: List of k feature functions. The ith feature function should
     take as input an H x W x D array and return a (one-dimensional) array of
     length F_i.
   - verbose: Boolean; if true, print progress.
+  - num_workers: Number of worker processes; defaults to the number of CPUs.
+    1 extracts everything in this process.
+  - batch_size: Number of images per batch (and per shard of work).
+  - cache_dir: If not None, the features are saved in this directory under
+    a hash of imgs and of the feature functions (see features_cache_key),
+    and loaded from there by later calls with the same inputs.
 
   Returns:
   An array of shape (N, F_1 + ... + F_k) where each column is the concatenation
   of all features for a single image.
   """
+  global _EXTRACT_JOB
   num_images = imgs.shape[0]
   if num_images == 0:
     return np.array([])
 
+  if cache_dir is not None:
+    path = os.path.join(cache_dir, 'features_%s.npy' %
+                        features_cache_key(imgs, feature_fns))
+    if os.path.exists(path):
+      if verbose:
+        print('Loading cached features from %s' % path)
+      return np.load(path)
+
   # Use the first image to determine feature dimensions
-  feature_dims = []
-  first_image_features = []
-  for feature_fn in feature_fns:
-    feats = feature_fn(imgs[0].squeeze())
-    assert len(feats.shape) == 1, 'Feature functions must be one-dimensional'
-    feature_dims.append(feats.size)
-    first_image_features.append(feats)
+  feature_dims = _feature_dims(imgs[0], feature_fns)
+
+  if num_workers is None:
+    num_workers = os.cpu_count() or 1
+  num_workers = min(num_workers, -(-num_images // batch_size))
+  # Workers inherit the images and the output through fork, so fall back to
+  # serial extraction where fork is unavailable.
+  if 'fork' not in multiprocessing.get_all_start_methods():
+    num_workers = 1
 
   # Now that we know the dimensions of the features, we can allocate a single
-  # big array to store all features as columns.
+  # big array to store all features as columns. With workers, it lives in an
+  # anonymous shared mapping that stays shared across fork.
   total_feature_dim = sum(feature_dims)
-  imgs_features = np.zeros((num_images, total_feature_dim))
-  imgs_features[0] = np.hstack(first_image_features).T
-
-  # Extract features for the rest of the images.
-  for i in xrange(1, num_images):
-    idx = 0
-    for feature_fn, feature_dim in zip(feature_fns, feature_dims):
-      next_idx = idx + feature_dim
-      imgs_features[i, idx:next_idx] = feature_fn(imgs[i].squeeze())
-      idx = next_idx
-    if verbose and i % 1000 == 0:
-      print('Done extracting features for %d / %d images' % (i, num_images))
+  shape = (num_images, total_feature_dim)
+  if num_workers == 1:
+    imgs_features = np.zeros(shape)
+  else:
+    buf = mmap.mmap(-1, max(int(np.prod(shape)) * 8, 1))
+    imgs_features = np.frombuffer(buf, dtype=np.float64,
+                                  count=int(np.prod(shape))).reshape(shape)
+
+  shards = [(start, min(start + batch_size, num_images))
+            for start in range(0, num_images, batch_size)]
+  def report(done):
+    num_done = 0
+    for n in done:
+      num_done += n
+      if verbose:
+        print('Done extracting features for %d / %d images' %
+              (num_done, num_images))
+
+  _EXTRACT_JOB = (imgs, feature_fns, feature_dims, imgs_features)
+  try:
+    if num_workers == 1:
+      report(_extract_shard(start, end) for start, end in shards)
+    else:
+      context = multiprocessing.get_context('fork')
+      with ProcessPoolExecutor(num_workers, mp_context=context) as pool:
+        report(pool.map(_extract_shard, *zip(*shards)))
+  finally:
+    _EXTRACT_JOB = None
+
+  if cache_dir is not None:
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    # Write under a temporary name first so that an interrupted save never
+    # leaves a truncated cache entry behind.
+    tmp_path = '%s.%d.tmp.npy' % (path[:-len('.npy')], os.getpid())
+    np.save(tmp_path, imgs_features)
+    os.replace(tmp_path, path)
 
   return imgs_features
 
 
+def _image_batches(imgs, batch_size):
+  """
+  Yields in-memory batches of at most batch_size images from an array (e.g.
+  an np.memmap) or from an iterable of image arrays.
+  """
+  if isinstance(imgs, np.ndarray):
+    for start in range(0, imgs.shape[0], batch_size):
+      yield np.asarray(imgs[start:start + batch_size])
+  else:
+    for chunk in imgs:
+      for start in range(0, chunk.shape[0], batch_size):
+        yield np.asarray(chunk[start:start + batch_size])
+
+
+def iter_features(imgs, feature_fns, batch_size=1000, dtype=np.float64):
+  """
+  Streaming version of extract_features: yields the features of imgs one
+  batch at a time, so that only one batch of images and of features is in
+  memory at once, whatever the number of images.
+
+  Inputs:
+  - imgs: N x H X W X C array of pixel data (typically an np.memmap, e.g.
+    from np.load(..., mmap_mode='r')), or an iterable of such arrays, e.g. a
+    generator reading a dataset chunk by chunk.
+  - feature_fns: List of feature functions; see extract_features.
+  - batch_size: Maximum number of images per yielded batch.
+  - dtype: Type of the yielded features.
+
+  Yields:
+  Arrays of shape (n, F_1 + ... + F_k) with the features of consecutive
+  batches of images.
+  """
+  feature_dims = None
+  for batch in _image_batches(imgs, batch_size):
+    if feature_dims is None:
+      feature_dims = _feature_dims(batch[0], feature_fns)
+    feats = np.empty((batch.shape[0], sum(feature_dims)), dtype=dtype)
+    _extract_block(batch, feature_fns, feature_dims, feats)
+    yield feats
+
+
+def stream_features(imgs, y, feature_fns, batch_size=200, dtype=np.float64):
+  """
+  Yields (X_batch, y_batch) minibatches of features and labels, e.g. for
+  nndl.linear_train.train_streaming, which then trains a linear classifier
+  without ever holding the features of the whole dataset.
+
+  Inputs:
+  - imgs, feature_fns, batch_size, dtype: See iter_features.
+  - y: Array of shape (N,) of labels, in the order of the images.
+  """
+  start = 0
+  for feats in iter_features(imgs, feature_fns, batch_size, dtype):
+    yield feats, np.asarray(y[start:start + feats.shape[0]])
+    start += feats.shape[0]
+
+
+def extract_features_to_file(imgs, feature_fns, path, num_images=None,
+                             batch_size=1000, dtype=np.float32,
+                             verbose=False):
+  """
+  Extracts the features of imgs batch by batch into a .npy file, keeping a
+  constant amount of memory in use.
+
+  Inputs:
+  - imgs, feature_fns, batch_size, dtype: See iter_features.
+  - path: Path of the .npy file to write.
+  - num_images: Total number of images; only needed if imgs is an iterable
+    of batches rather than an array.
+  - verbose: Boolean; if true, print progress.
+
+  Returns:
+  The features as a read-write np.memmap of shape (N, F_1 + ... + F_k) on
+  path, which can be reopened later with np.load(path, mmap_mode='r').
+  """
+  if num_images is None:
+    num_images = imgs.shape[0]
+  out = None
+  start = 0
+  for feats in iter_features(imgs, feature_fns, batch_size, dtype):
+    if out is None:
+      out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                      shape=(num_images, feats.shape[1]))
+    if start + feats.shape[0] > num_images:
+      raise ValueError('Invalid num_images "%s"' % num_images)
+    out[start:start + feats.shape[0]] = feats
+    start += feats.shape[0]
+    if verbose:
+      print('Done extracting features for %d / %d images' %
+            (start, num_images))
+
+  if out is None:
+    return np.array([])
+  if start != num_images:
+    raise ValueError('Invalid num_images "%s"' % num_images)
+  out.flush()
+  return out
+
+
 def rgb2gray(rgb):
   """Convert RGB image to grayscale
 
@@ -69,6 +323,71 @@ def rgb2gray(rgb):
   return np.dot(rgb[...,:3], [0.299, 0.587, 0.144])
 
 
+def hog_features(imgs, chunk_pixels=2**20):
+  """Compute the HOG features of a batch of images at once
+
+    The images are processed in chunks of about chunk_pixels pixels. Within a
+    chunk, the gradients, orientation bins and cell sums of all images are
+    computed with whole-array operations, and all histograms are accumulated
+    by a single bincount.
+
+    Parameters:
+      imgs : N x H x W x C array of rgb images, or N x H x W array of
+        grayscale images
+      chunk_pixels : approximate number of pixels processed at once
+
+    Returns:
+      feats: N x F array whose ith row is hog_feature(imgs[i])
+
+  """
+  imgs = np.asarray(imgs)
+  N, sx, sy = imgs.shape[:3] # image size
+  orientations = 9 # number of gradient bins
+  cx, cy = (8, 8) # pixels per cell
+  n_cellsx = sx // cx  # number of cells in x
+  n_cellsy = sy // cy  # number of cells in y
+  num_features = n_cellsy * n_cellsx * orientations
+  # bin i holds the orientations in [edges[i], edges[i] + 180 / orientations)
+  edges = 180 / orientations * np.arange(orientations)
+
+  # Flat index of the (cell column, cell row) histogram each pixel of a
+  # cropped image falls in, matching the cell layout of hog_feature.
+  cell_rows = np.arange(n_cellsx * cx) // cx
+  cell_cols = np.arange(n_cellsy * cy) // cy
+  cell_index = (cell_cols[np.newaxis, :] * n_cellsx +
+                cell_rows[:, np.newaxis]) * orientations
+
+  feats = np.empty((N, num_features))
+  chunk = max(chunk_pixels // (sx * sy), 1)
+  for start in range(0, N, chunk):
+    block = imgs[start:start + chunk]
+    n = block.shape[0]
+    # convert rgb to grayscale if needed
+    image = rgb2gray(block) if block.ndim == 4 else block.astype(float)
+
+    gx = np.zeros(image.shape)
+    gy = np.zeros(image.shape)
+    gx[:, :, :-1] = np.diff(image, n=1, axis=2) # gradient on x-direction
+    gy[:, :-1, :] = np.diff(image, n=1, axis=1) # gradient on y-direction
+    grad_mag = np.sqrt(gx ** 2 + gy ** 2) # gradient magnitude
+    grad_ori = np.arctan2(gy, (gx + 1e-15)) * (180 / np.pi) + 90 # orientation
+
+    grad_mag = grad_mag[:, :n_cellsx * cx, :n_cellsy * cy]
+    grad_ori = grad_ori[:, :n_cellsx * cx, :n_cellsy * cy]
+    # Orientations outside (0, 180) belong to no bin.
+    bins = np.searchsorted(edges, grad_ori, side='right') - 1
+    weights = np.where((grad_ori > 0) & (grad_ori < 180), grad_mag, 0)
+    index = (np.arange(n)[:, np.newaxis, np.newaxis] * num_features +
+             cell_index + np.maximum(bins, 0))
+    hist = np.bincount(index.ravel(), weights=weights.ravel(),
+                       minlength=n * num_features)
+    # average over the cx x cy pixels of each cell
+    feats[start:start + n] = hist.reshape(n, num_features) / (cx * cy)
+
+  return feats
+
+
+@batched(hog_features)
 def hog_feature(im):
   """Compute Histogram of Gradient (HOG) feature for an image
   
@@ -86,43 +405,79 @@ def hog_feature(im):
       feat: Histogram of Gradient (HOG) feature
     
   """
-  
-  # convert rgb to grayscale if needed
-  if im.ndim == 3:
-    image = rgb2gray(im)
-  else:
-    image = np.at_least_2d(im)
+  return hog_features(np.asarray(im)[np.newaxis])[0]
 
-  sx, sy = image.shape # image size
-  orientations = 9 # number of gradient bins
-  cx, cy = (8, 8) # pixels per cell
 
-  gx = np.zeros(image.shape)
-  gy = np.zeros(image.shape)
-  gx[:, :-1] = np.diff(image, n=1, axis=1) # compute gradient on x-direction
-  gy[:-1, :] = np.diff(image, n=1, axis=0) # compute gradient on y-direction
-  grad_mag = np.sqrt(gx ** 2 + gy ** 2) # gradient magnitude
-  grad_ori = np.arctan2(gy, (gx + 1e-15)) * (180 / np.pi) + 90 # gradient orientation
-
-  n_cellsx = int(np.floor(sx / cx))  # number of cells in x
-  n_cellsy = int(np.floor(sy / cy))  # number of cells in y
-  # compute orientations integral images
-  orientation_histogram = np.zeros((n_cellsx, n_cellsy, orientations))
-  for i in range(orientations):
-    # create new integral image for this orientation
-    # isolate orientations in this range
-    temp_ori = np.where(grad_ori < 180 / orientations * (i + 1),
-                        grad_ori, 0)
-    temp_ori = np.where(grad_ori >= 180 / orientations * i,
-                        temp_ori, 0)
-    # select magnitudes for those orientations
-    cond2 = temp_ori > 0
-    temp_mag = np.where(cond2, grad_mag, 0)
-    orientation_histogram[:,:,i] = uniform_filter(temp_mag, size=(cx, cy))[cx/2::cx, cy/2::cy].T
-  
-  return orientation_histogram.ravel()
+def rgb2hue(rgb):
+  """
+  Hue channel of matplotlib.colors.rgb_to_hsv, without computing the
+  saturation and value channels.
+
+  Inputs:
+  - rgb: Array of shape (..., 3) of RGB values in [0, 1].
+
+  Returns:
+    Array of shape (...) of hues in [0, 1).
+  """
+  r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+  # Elementwise max/min of the three channels are much faster than
+  # reductions over a length-3 last axis.
+  rgb_max = np.maximum(np.maximum(r, g), b)
+  delta = rgb_max - np.minimum(np.minimum(r, g), b)
+  safe_delta = np.where(delta > 0, delta, 1)
+  # When several channels are the max, blue takes precedence over green and
+  # green over red, as in rgb_to_hsv.
+  hue = np.where(b == rgb_max, 4. + (r - g) / safe_delta,
+                 np.where(g == rgb_max, 2. + (b - r) / safe_delta,
+                          (g - b) / safe_delta))
+  hue = np.where(delta > 0, hue, 0)
+  return (hue / 6.0) % 1.0
+
 
+def color_histograms_hsv(imgs, nbin=10, xmin=0, xmax=255, normalized=True,
+                         chunk_pixels=2**20):
+  """
+  Compute the hue color histograms of a batch of images at once.
+
+  The images are processed in chunks of about chunk_pixels pixels; the hues
+  of a chunk are computed in one pass and binned by a single bincount over
+  per-image offset bin indices.
+
+  Inputs:
+  - imgs: N x H x W x C array of pixel data for N RGB images.
+  - nbin, xmin, xmax, normalized: See color_histogram_hsv.
+  - chunk_pixels: Approximate number of pixels processed at once.
+
+  Returns:
+    An array of shape (N, nbin) whose ith row is color_histogram_hsv(imgs[i]).
+  """
+  imgs = np.asarray(imgs)
+  N = imgs.shape[0]
+  bins = np.linspace(xmin, xmax, nbin+1)
+  feats = np.empty((N, nbin))
+  chunk = max(chunk_pixels // (imgs.shape[1] * imgs.shape[2]), 1)
+  for start in range(0, N, chunk):
+    block = imgs[start:start + chunk]
+    n = block.shape[0]
+    hue = rgb2hue(block / xmax).reshape(n, -1) * xmax
+
+    # Same bins as np.histogram: half-open, except for the last one, which
+    # includes xmax. Out-of-range hues are not counted.
+    idx = np.searchsorted(bins, hue, side='right') - 1
+    idx[hue == bins[-1]] = nbin - 1
+    valid = (hue >= bins[0]) & (hue <= bins[-1])
+    idx += np.arange(n)[:, np.newaxis] * nbin
+    imhist = np.bincount(idx[valid], minlength=n * nbin).reshape(n, nbin)
+
+    if normalized:
+      feats[start:start + n] = imhist / np.sum(imhist, axis=1, keepdims=True)
+    else:
+      feats[start:start + n] = imhist * np.diff(bins)
+
+  return feats
 
+
+@batched(color_histograms_hsv)
 def color_histogram_hsv(im, nbin=10, xmin=0, xmax=255, normalized=True):
   """
   Compute color histogram for an image using hue.
@@ -138,14 +493,8 @@ def color_histogram_hsv(im, nbin=10, xmin=0, xmax=255, normalized=True):
     1D vector of length nbin giving the color histogram over the hue of the
     input image.
   """
-  ndim = im.ndim
-  bins = np.linspace(xmin, xmax, nbin+1)
-  hsv = matplotlib.colors.rgb_to_hsv(im/xmax) * xmax
-  imhist, bin_edges = np.histogram(hsv[:,:,0], bins=bins, density=normalized)
-  imhist = imhist * np.diff(bin_edges)
-
-  # return histogram
-  return imhist
+  return color_histograms_hsv(np.asarray(im)[np.newaxis], nbin, xmin, xmax,
+                              normalized)[0]
 
 
 pass
@@ -1,12 +1,17 @@
 from __future__ import print_function, division
 from builtins import range
 from builtins import object
+import copy
+import json
 import os
-import pickle as pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
 from nndl import optim
+from cs231n import checkpoint
+from cs231n.param_buffer import ParamBuffer
 
 
 class Solver(object):
@@ -25,7 +30,8 @@ class Solver(object):
     procedure and train the model.
 
     After the train() method returns, model.params will contain the parameters
-    that performed best on the validation set over the course of training.
+    that performed best on the validation set over the course of training
+    (or their moving average, see ema_decay).
     In addition, the instance variable solver.loss_history will contain a list
     of all losses encountered during training and the instance variables
     solver.train_acc_history and solver.val_acc_history will be lists of the
@@ -56,6 +62,10 @@ class Solver(object):
     - model.params must be a dictionary mapping string parameter names to numpy
       arrays containing parameter values.
 
+    - model.scores(X), if present, must return the same scores as model.loss(X);
+      it is used instead of model.loss(X) to check accuracy and may skip the
+      work that is only needed for the backward pass, such as caches.
+
     - model.loss(X, y) must be a function that computes training-time loss and
       gradients, and test-time classification scores, with the following inputs
       and outputs:
@@ -109,8 +119,34 @@ class Solver(object):
           accuracy; default is 1000; set to None to use entire training set.
         - num_val_samples: Number of validation samples to use to check val
           accuracy; default is None, which uses the entire validation set.
-        - checkpoint_name: If not None, then save model checkpoints here every
-          epoch.
+        - fixed_eval_samples: If True (the default), the training and
+          validation samples used to check accuracy are drawn once, without
+          replacement, and reused at every check. If False, new samples are
+          drawn (with replacement) for every check.
+        - async_eval: If True, accuracy checks run in a background thread on
+          a copy of the model, so that training continues while they run.
+          Their results (accuracy histories, best parameters, checkpoints and
+          printouts) are applied in order as they complete, and train() waits
+          for the last one before returning. The checkpoint of a check holds
+          the training state of the iteration the check was made at.
+        - checkpoint_name: If not None, then save checkpoints of the model
+          parameters and optimizer state with this path prefix at every
+          accuracy check (see cs231n/checkpoint.py). They are written on a
+          background thread; load_checkpoint resumes from one.
+        - checkpoint_keep_last: If not None, only the checkpoint_keep_last
+          most recent checkpoints are kept on disk.
+        - telemetry: If not None, a cs231n.telemetry.Telemetry instance that
+          receives a record of timings, learning rate, gradient norms and
+          throughput for every iteration.
+        - best_params_path: If not None, the best parameters are kept in
+          memory-mapped .npy files with this path prefix instead of in
+          memory (see cs231n/param_buffer.py).
+        - ema_decay: If not None, an average of the parameters is maintained
+          in place after every update, in solver.ema_params: an exponential
+          moving average with this decay (e.g. 0.999), or the uniform
+          (Polyak) average of all iterates if ema_decay is 'polyak'. At the
+          end of training the averaged parameters are copied into the model
+          instead of the best ones.
         """
         self.model = model
         self.X_train = data['X_train']
@@ -126,10 +162,16 @@ class Solver(object):
         self.num_epochs = kwargs.pop('num_epochs', 10)
         self.num_train_samples = kwargs.pop('num_train_samples', 1000)
         self.num_val_samples = kwargs.pop('num_val_samples', None)
+        self.fixed_eval_samples = kwargs.pop('fixed_eval_samples', True)
+        self.async_eval = kwargs.pop('async_eval', False)
 
         self.checkpoint_name = kwargs.pop('checkpoint_name', None)
+        self.checkpoint_keep_last = kwargs.pop('checkpoint_keep_last', None)
         self.print_every = kwargs.pop('print_every', 10)
         self.verbose = kwargs.pop('verbose', True)
+        self.telemetry = kwargs.pop('telemetry', None)
+        self.best_params_path = kwargs.pop('best_params_path', None)
+        self.ema_decay = kwargs.pop('ema_decay', None)
 
         # Throw an error if there are extra keyword arguments
         if len(kwargs) > 0:
@@ -142,6 +184,11 @@ class Solver(object):
             raise ValueError('Invalid update_rule "%s"' % self.update_rule)
         self.update_rule = getattr(optim, self.update_rule)
 
+        if self.ema_decay is not None and self.ema_decay != 'polyak' and \
+                not (isinstance(self.ema_decay, float) and
+                     0 < self.ema_decay < 1):
+            raise ValueError('Invalid ema_decay "%s"' % self.ema_decay)
+
         self._reset()
 
 
@@ -152,11 +199,21 @@ class Solver(object):
         """
         # Set up some variables for book-keeping
         self.epoch = 0
+        self.iteration = 0
         self.best_val_acc = 0
         self.best_params = {}
+        self.ema_params = None
+        self._best_buffer = None
+        self._ema_buffer = None
+        self._ema_count = 0
         self.loss_history = []
         self.train_acc_history = []
         self.val_acc_history = []
+        self._eval_masks = None
+        self._eval_sets = None
+        self._pending_evals = []
+        self._executor = None
+        self._checkpoint_writer = None
 
         # Make a deep copy of the optim_config for each parameter
         self.optim_configs = {}
@@ -170,15 +227,19 @@ class Solver(object):
         Make a single gradient update. This is called by train() and should not
         be called manually.
         """
+        start = time.perf_counter()
+
         # Make a minibatch of training data
         num_train = self.X_train.shape[0]
         batch_mask = np.random.choice(num_train, self.batch_size)
         X_batch = self.X_train[batch_mask]
         y_batch = self.y_train[batch_mask]
+        gathered = time.perf_counter()
 
         # Compute loss and gradient
         loss, grads = self.model.loss(X_batch, y_batch)
         self.loss_history.append(loss)
+        computed = time.perf_counter()
 
         # Perform a parameter update
         for p, w in self.model.params.items():
@@ -187,31 +248,248 @@ class Solver(object):
             next_w, next_config = self.update_rule(w, dw, config)
             self.model.params[p] = next_w
             self.optim_configs[p] = next_config
+        if self.ema_decay is not None:
+            self._update_ema()
+        end = time.perf_counter()
 
+        self._time_step(start, gathered, computed, end)
+        if self.telemetry is not None:
+            self._record_step(loss, grads, start, gathered, computed, end)
 
-    def _save_checkpoint(self):
-        if self.checkpoint_name is None: return
-        checkpoint = {
-          'model': self.model,
-          'update_rule': self.update_rule,
-          'lr_decay': self.lr_decay,
-          'optim_config': self.optim_config,
-          'batch_size': self.batch_size,
-          'num_train_samples': self.num_train_samples,
-          'num_val_samples': self.num_val_samples,
+
+    def _time_step(self, start, gathered, computed, end):
+        """
+        Called by _step with the perf_counter() times at which the step
+        started, the minibatch was gathered, the loss was computed and the
+        update finished. Does nothing; subclasses can override it to profile
+        training (see cs231n/solver_benchmark.py).
+        """
+        pass
+
+
+    def _update_ema(self):
+        """
+        Folds the current parameters into self.ema_params, in place.
+        """
+        self._ema_count += 1
+        if self._ema_buffer is None:
+            self._ema_buffer = ParamBuffer(self.model.params)
+            self._ema_buffer.copy_from(self.model.params)
+            self.ema_params = self._ema_buffer.views
+            return
+        if self.ema_decay == 'polyak':
+            weight = 1.0 / self._ema_count
+        else:
+            weight = 1.0 - self.ema_decay
+        self._ema_buffer.update_average(self.model.params, weight)
+
+
+    def _store_best(self, params):
+        """
+        Copies params into the preallocated best parameter buffers, which
+        self.best_params refers to.
+        """
+        if self._best_buffer is None:
+            self._best_buffer = ParamBuffer(params, self.best_params_path)
+        self._best_buffer.copy_from(params)
+        self.best_params = self._best_buffer.views
+
+
+    def _record_step(self, loss, grads, start, gathered, computed, end):
+        """
+        Sends the metrics of the last iteration to self.telemetry.
+        """
+        record = {
+          'iteration': len(self.loss_history),
+          'epoch': self.epoch,
+          'loss': float(loss),
+          'learning_rate': next(iter(self.optim_configs.values()), {}).get(
+              'learning_rate'),
+          'gather_time': gathered - start,
+          'loss_time': computed - gathered,
+          'update_time': end - computed,
+          'step_time': end - start,
+          'samples_per_sec': self.batch_size / (end - start),
+        }
+        squared_norms = 0.0
+        for p in sorted(grads):
+            norm = float(np.linalg.norm(grads[p].ravel()))
+            record['grad_norm_%s' % p] = norm
+            squared_norms += norm**2
+        record['grad_norm'] = np.sqrt(squared_norms)
+        self.telemetry.record(**record)
+
+
+    def _checkpoint_state(self, params=None):
+        """
+        A copy of the training state a checkpoint taken now would hold,
+        except for the accuracy histories and the best parameters, which
+        are only known once the accuracy check made at this point is done.
+        Asynchronous checks keep it until their result is collected, so that
+        their checkpoint describes the iteration they were made at.
+        """
+        if params is None:
+            params = {k: v.copy() for k, v in self.model.params.items()}
+        return {
           'epoch': self.epoch,
-          'loss_history': self.loss_history,
-          'train_acc_history': self.train_acc_history,
-          'val_acc_history': self.val_acc_history,
+          'iteration': self.iteration,
+          'params': params,
+          'optim_configs': copy.deepcopy(self.optim_configs),
+          'arrays': {k: np.array(v) for k, v in self._training_state().items()},
+          'ema_count': self._ema_count,
+          'num_losses': len(self.loss_history),
         }
-        filename = '%s_epoch_%d.pkl' % (self.checkpoint_name, self.epoch)
+
+
+    def _save_checkpoint(self, state=None):
+        if self.checkpoint_name is None: return
+        if state is None:
+            state = self._checkpoint_state(self.model.params)
+        if self._checkpoint_writer is None:
+            self._checkpoint_writer = checkpoint.CheckpointWriter(
+                self.checkpoint_name, self.checkpoint_keep_last)
+        arrays = dict(state['arrays'])
+        for k, v in self.best_params.items():
+            arrays['best/' + k] = v
+        filename = self._checkpoint_writer.save(
+            state['epoch'], state['params'], state['optim_configs'],
+            self.loss_history[:state['num_losses']], self.train_acc_history,
+            self.val_acc_history, arrays=arrays,
+            iteration=state['iteration'], best_val_acc=self.best_val_acc,
+            ema_count=state['ema_count'])
         if self.verbose:
             print('Saving checkpoint to "%s"' % filename)
-        with open(filename, 'wb') as f:
-            pickle.dump(checkpoint, f)
 
 
-    def check_accuracy(self, X, y, num_samples=None, batch_size=100):
+    def _training_state(self):
+        """
+        The arrays, besides the parameters and optimizer configs, that a
+        checkpoint needs for train() to resume exactly where it stopped: the
+        state of numpy's global RNG (which draws the minibatches, so it also
+        holds the position of the sampler), the averaged parameters, the
+        fixed accuracy check samples and the layer state kept by the model
+        (see _layer_params). The best parameters are added by
+        _save_checkpoint.
+        """
+        _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        arrays = {
+          'rng/keys': keys,
+          'rng/pos': pos,
+          'rng/has_gauss': has_gauss,
+          'rng/cached_gaussian': cached_gaussian,
+        }
+        for k, v in (self.ema_params or {}).items():
+            arrays['ema/' + k] = v
+        for i, mask in enumerate(self._eval_masks or []):
+            if mask is not None:
+                arrays['eval_mask/%d' % i] = mask
+        for name, param in self._layer_params().items():
+            for k, v in param.items():
+                if isinstance(v, np.random.Generator):
+                    arrays['%s/%s' % (name, k)] = json.dumps(
+                        v.bit_generator.state)
+                elif isinstance(v, (np.ndarray, np.number, int, float)):
+                    arrays['%s/%s' % (name, k)] = v
+        return arrays
+
+
+    def _layer_params(self):
+        """
+        The parameter dictionaries that the model passes to its layers and
+        that the layers update between calls: the batchnorm running
+        statistics in model.bn_params and the dropout mask generator in
+        model.dropout_param.
+        """
+        params = {}
+        for i, bn_param in enumerate(getattr(self.model, 'bn_params', [])):
+            params['bn_param/%d' % i] = bn_param
+        if getattr(self.model, 'dropout_param', None):
+            params['dropout_param'] = self.model.dropout_param
+        return params
+
+
+    def _restore_training_state(self, state):
+        arrays = state['arrays']
+        if 'rng/keys' in arrays:
+            np.random.set_state(('MT19937', arrays['rng/keys'],
+                                 int(arrays['rng/pos']),
+                                 int(arrays['rng/has_gauss']),
+                                 float(arrays['rng/cached_gaussian'])))
+        self.best_val_acc = state.get('best_val_acc', 0)
+        self._ema_count = state.get('ema_count', 0)
+        self._eval_masks = None
+        self._eval_sets = None
+        best, ema = {}, {}
+        layer_params = self._layer_params()
+        for key, value in arrays.items():
+            parts = key.split('/')
+            if parts[0] == 'best':
+                best[parts[1]] = value
+            elif parts[0] == 'ema':
+                ema[parts[1]] = value
+            elif parts[0] == 'eval_mask':
+                if self._eval_masks is None:
+                    self._eval_masks = [None, None]
+                self._eval_masks[int(parts[1])] = value
+            elif '/'.join(parts[:-1]) in layer_params:
+                if value.dtype.kind == 'U':
+                    # A generator, saved as the JSON of its state.
+                    rng_state = json.loads(value.item())
+                    bit_generator = getattr(np.random,
+                                            rng_state['bit_generator'])()
+                    bit_generator.state = rng_state
+                    value = np.random.Generator(bit_generator)
+                elif value.ndim == 0:
+                    value = value.item()
+                layer_params['/'.join(parts[:-1])][parts[-1]] = value
+        if best:
+            self._store_best(best)
+        if ema:
+            self._ema_buffer = ParamBuffer(ema)
+            self._ema_buffer.copy_from(ema)
+            self.ema_params = self._ema_buffer.views
+
+
+    def load_checkpoint(self, path):
+        """
+        Restores the complete training state from a checkpoint written by
+        this class: model parameters, optimizer state, epoch, iteration,
+        histories, best parameters, the state of numpy's global RNG and the
+        samples used to check accuracy. train() then continues the
+        interrupted run from that point and produces the same parameters and
+        histories, bit for bit, as a run that was never interrupted (with
+        async_eval too: the checks made after the checkpoint are made again).
+
+        Inputs:
+        - path: Path of a checkpoint, e.g. from
+          cs231n.checkpoint.latest_checkpoint(checkpoint_name).
+        """
+        state = checkpoint.load_checkpoint(path)
+        for k, v in state['params'].items():
+            self.model.params[k] = v
+        self.optim_configs = state['optim_configs']
+        self.epoch = state['epoch']
+        self.iteration = state['iteration']
+        self.loss_history = state['loss_history']
+        self.train_acc_history = state['train_acc_history']
+        self.val_acc_history = state['val_acc_history']
+        self._restore_training_state(state)
+
+        # Later checkpoints continue the history files of this one; with a
+        # different checkpoint_name the whole history is written again.
+        prefix = checkpoint.checkpoint_prefix(path)
+        if self.checkpoint_name is None:
+            self.checkpoint_name = prefix
+        if self._checkpoint_writer is not None:
+            self._checkpoint_writer.close()
+        counts = (state['num_losses'], state['num_accs']) \
+            if self.checkpoint_name == prefix else (0, 0)
+        self._checkpoint_writer = checkpoint.CheckpointWriter(
+            self.checkpoint_name, self.checkpoint_keep_last, *counts)
+
+
+    def check_accuracy(self, X, y, num_samples=None, batch_size=100,
+                       model=None):
         """
         Check accuracy of the model on the provided data.
 
@@ -222,12 +500,17 @@ class Solver(object):
           on num_samples datapoints.
         - batch_size: Split X and y into batches of this size to avoid using
           too much memory.
+        - model: Model to evaluate; defaults to self.model.
 
         Returns:
         - acc: Scalar giving the fraction of instances that were correctly
           classified by the model.
         """
 
+        if model is None:
+            model = self.model
+        scores_fn = getattr(model, 'scores', model.loss)
+
         # Maybe subsample the data
         N = X.shape[0]
         if num_samples is not None and N > num_samples:
@@ -244,7 +527,7 @@ class Solver(object):
         for i in range(num_batches):
             start = i * batch_size
             end = (i + 1) * batch_size
-            scores = self.model.loss(X[start:end])
+            scores = scores_fn(X[start:end])
             y_pred.append(np.argmax(scores, axis=1))
         y_pred = np.hstack(y_pred)
         acc = np.mean(y_pred == y)
@@ -252,6 +535,91 @@ class Solver(object):
         return acc
 
 
+    def _eval_data(self):
+        """
+        Returns the (X, y) pairs of training and validation data that the
+        next accuracy check uses (see fixed_eval_samples). Samples are drawn
+        here, in the training thread, even when the check is asynchronous.
+        """
+        if self._eval_sets is not None:
+            return self._eval_sets
+        data = ((self.X_train, self.y_train, self.num_train_samples),
+                (self.X_val, self.y_val, self.num_val_samples))
+        masks = self._eval_masks
+        if masks is None:
+            masks = []
+            for X, y, num_samples in data:
+                N = X.shape[0]
+                mask = None
+                if num_samples is not None and N > num_samples:
+                    if self.fixed_eval_samples:
+                        mask = np.sort(np.random.choice(N, num_samples,
+                                                        replace=False))
+                    else:
+                        mask = np.random.choice(N, num_samples)
+                masks.append(mask)
+        sets = [(X, y) if mask is None else (X[mask], y[mask])
+                for (X, y, _), mask in zip(data, masks)]
+        if self.fixed_eval_samples:
+            self._eval_masks = masks
+            self._eval_sets = sets
+        return sets
+
+
+    def _accuracies(self, model, sets):
+        return [self.check_accuracy(X, y, model=model) for X, y in sets]
+
+
+    def _evaluate(self):
+        """
+        Checks train and val accuracy now, or submits the check to the
+        background thread if async_eval is set.
+        """
+        sets = self._eval_data()
+        if not self.async_eval:
+            accuracies = self._accuracies(self.model, sets)
+            self._record_accuracy(self.epoch, self.model, accuracies)
+            return
+        # The update rules may modify the parameters in place, so the check
+        # runs on a snapshot of the model.
+        model = copy.deepcopy(self.model)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        future = self._executor.submit(self._accuracies, model, sets)
+        state = None
+        if self.checkpoint_name is not None:
+            state = self._checkpoint_state(model.params)
+        self._pending_evals.append((self.epoch, model, future, state))
+
+
+    def _collect_evaluations(self, wait=False):
+        """
+        Applies the results of the finished asynchronous accuracy checks, in
+        the order they were submitted. If wait is true, waits for all of them.
+        """
+        while self._pending_evals and (wait or self._pending_evals[0][2].done()):
+            epoch, model, future, state = self._pending_evals.pop(0)
+            self._record_accuracy(epoch, model, future.result(), state)
+
+
+    def _record_accuracy(self, epoch, model, accuracies, state=None):
+        train_acc, val_acc = accuracies
+        self.train_acc_history.append(train_acc)
+        self.val_acc_history.append(val_acc)
+
+        if self.verbose:
+            print('(Epoch %d / %d) train acc: %f; val_acc: %f' % (
+                   epoch, self.num_epochs, train_acc, val_acc))
+
+        # Keep track of the best model
+        if val_acc > self.best_val_acc:
+            self.best_val_acc = val_acc
+            self._store_best(model.params)
+
+        # Checkpoints include the best parameters, so they are written last.
+        self._save_checkpoint(state)
+
+
     def train(self):
         """
         Run optimization to train the model.
@@ -260,8 +628,9 @@ class Solver(object):
         iterations_per_epoch = max(num_train // self.batch_size, 1)
         num_iterations = self.num_epochs * iterations_per_epoch
 
-        for t in range(num_iterations):
+        for t in range(self.iteration, num_iterations):
             self._step()
+            self.iteration = t + 1
 
             # Maybe print training loss
             if self.verbose and t % self.print_every == 0:
@@ -281,24 +650,24 @@ class Solver(object):
             first_it = (t == 0)
             last_it = (t == num_iterations - 1)
             if first_it or last_it or epoch_end:
-                train_acc = self.check_accuracy(self.X_train, self.y_train,
-                    num_samples=self.num_train_samples)
-                val_acc = self.check_accuracy(self.X_val, self.y_val,
-                    num_samples=self.num_val_samples)
-                self.train_acc_history.append(train_acc)
-                self.val_acc_history.append(val_acc)
-                self._save_checkpoint()
-
-                if self.verbose:
-                    print('(Epoch %d / %d) train acc: %f; val_acc: %f' % (
-                           self.epoch, self.num_epochs, train_acc, val_acc))
-
-                # Keep track of the best model
-                if val_acc > self.best_val_acc:
-                    self.best_val_acc = val_acc
-                    self.best_params = {}
-                    for k, v in self.model.params.items():
-                        self.best_params[k] = v.copy()
-
-        # At the end of training swap the best params into the model
-        self.model.params = self.best_params
+                self._evaluate()
+            self._collect_evaluations()
+
+        self._collect_evaluations(wait=True)
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._checkpoint_writer is not None:
+            self._checkpoint_writer.close()
+        self.iteration = 0
+        self._checkpoint_writer = None
+
+        # At the end of training copy the best (or averaged) params into the
+        # model's own arrays
+        final = self._ema_buffer if self._ema_buffer is not None else \
+            self._best_buffer
+        if final is not None:
+            final.copy_to(self.model.params)
+
+        if self.telemetry is not None:
+            self.telemetry.flush(wait=True)
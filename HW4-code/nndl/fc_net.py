@@ -250,7 +250,7 @@ class FullyConnectedNet(object):
       self.dropout_param['mode'] = mode   
     if self.use_batchnorm:
       for bn_param in self.bn_params:
-        bn_param[mode] = mode
+        bn_param['mode'] = mode
 
     scores = None
     
@@ -318,3 +318,26 @@ class FullyConnectedNet(object):
     # END YOUR CODE HERE
     # ================================================================ #
     return loss, grads
+
+
+  def scores(self, X):
+    """
+    Test-time classification scores, equal to self.loss(X), computed without
+    keeping the caches of the layers so that each intermediate activation
+    can be freed as soon as the next one is computed. Used by Solver to
+    check accuracy.
+    """
+    scores = X.astype(self.dtype)
+    dropout_param = dict(self.dropout_param, mode='test')
+    for i in range(self.num_layers):
+      scores = affine_forward(scores, self.params["W" + str(i + 1)],
+                              self.params["b" + str(i + 1)])[0]
+      if i < self.num_layers - 1:
+        if self.use_batchnorm:
+          scores = batchnorm_forward(scores, self.params["gamma" + str(i + 1)],
+                                     self.params["beta" + str(i + 1)],
+                                     dict(self.bn_params[i], mode='test'))[0]
+        scores = relu_forward(scores)[0]
+        if self.use_dropout:
+          scores = dropout_forward(scores, dropout_param)[0]
+    return scores
@@ -12,6 +12,13 @@ from nndl.layers import *
 from cs231n.gradient_check import eval_numerical_gradient, eval_numerical_gradient_array
 from nndl.layer_utils import affine_relu_forward, affine_relu_backward
 from nndl.fc_net import FullyConnectedNet
+import os
+import shutil
+import tempfile
+import time
+
+from cs231n.solver import Solver
+from cs231n.checkpoint import list_checkpoints
 
 def rel_error(x, y):
   """ returns relative error """
@@ -123,3 +130,75 @@ def fc_net_test():
         f = lambda _: model.loss(X, y)[0]
         grad_num = eval_numerical_gradient(f, model.params[name], verbose=False, h=1e-5)
         print('{} relative error: {}'.format(name, rel_error(grad_num, grads[name])))
+
+def solver_async_eval_test():
+    # Asynchronous accuracy checks run on a snapshot of the model, so with the
+    # same seed they must give exactly the histories of synchronous checks,
+    # dropout included.
+    N, D, C = 200, 15, 10
+    np.random.seed(0)
+    data = {'X_train': np.random.randn(N, D), 'y_train': np.random.randint(C, size=N),
+            'X_val': np.random.randn(N // 2, D), 'y_val': np.random.randint(C, size=N // 2)}
+
+    histories = []
+    for async_eval in [False, True, False]:
+      np.random.seed(1)
+      model = FullyConnectedNet([20, 30], input_dim=D, num_classes=C, dropout=0.5,
+                                use_batchnorm=True, dtype=np.float64)
+      solver = Solver(model, data, num_epochs=3, batch_size=25, async_eval=async_eval,
+                      optim_config={'learning_rate': 1e-2}, verbose=False)
+      solver.train()
+      histories.append((solver.loss_history, solver.train_acc_history,
+                        solver.val_acc_history))
+
+    print('Seeded runs with dropout should match exactly:')
+    print('sync runs match: {}'.format(histories[0] == histories[2]))
+    print('async matches sync: {}'.format(histories[0] == histories[1]))
+
+def solver_async_resume_test():
+    # A run resumed from any checkpoint written during training with
+    # asynchronous accuracy checks must end exactly like the run that wrote
+    # it: same parameters, histories and best validation accuracy. The checks
+    # are slowed down so that several epochs pass while each one runs.
+    N, D, C = 200, 15, 10
+    np.random.seed(0)
+    data = {'X_train': np.random.randn(N, D), 'y_train': np.random.randint(C, size=N),
+            'X_val': np.random.randn(N // 2, D), 'y_val': np.random.randint(C, size=N // 2)}
+
+    class SlowCheckSolver(Solver):
+      def _accuracies(self, model, sets):
+        time.sleep(0.2)
+        return super(SlowCheckSolver, self)._accuracies(model, sets)
+
+    def make_solver(seed, **kwargs):
+      np.random.seed(seed)
+      model = FullyConnectedNet([20, 30], input_dim=D, num_classes=C, dropout=0.5,
+                                use_batchnorm=True, dtype=np.float64)
+      return SlowCheckSolver(model, data, num_epochs=4, batch_size=25, update_rule='adam',
+                    async_eval=True, optim_config={'learning_rate': 1e-2},
+                    verbose=False, **kwargs)
+
+    directory = tempfile.mkdtemp()
+    try:
+      prefix = os.path.join(directory, 'run')
+      solver = make_solver(1, checkpoint_name=prefix)
+      solver.train()
+      paths = list_checkpoints(prefix)
+      print('Expected one checkpoint per accuracy check:')
+      print('{} checkpoints for {} checks'.format(len(paths), len(solver.val_acc_history)))
+
+      print('Resumed runs should match exactly:')
+      for path in paths[:-1]:
+        resumed = make_solver(2)
+        resumed.load_checkpoint(path)
+        resumed.checkpoint_name = None
+        resumed.train()
+        same = solver.loss_history == resumed.loss_history and \
+            solver.val_acc_history == resumed.val_acc_history and \
+            solver.train_acc_history == resumed.train_acc_history and \
+            solver.best_val_acc == resumed.best_val_acc and \
+            all(np.array_equal(solver.model.params[k], resumed.model.params[k])
+                for k in solver.model.params)
+        print('{}: {}'.format(os.path.basename(path), same))
+    finally:
+      shutil.rmtree(directory)
@@ -316,21 +316,32 @@ def dropout_forward(x, dropout_param):
       if the mode is test, then just return the input.
     - seed: Seed for the random number generator. Passing seed makes this
       function deterministic, which is needed for gradient checking but not in
-      real networks.
+      real networks. The global numpy RNG is never reseeded.
+    - rng: Optional numpy.random.Generator used to draw the masks. If it is
+      missing (and no seed is given) one is created on the first training
+      pass, seeded from the global numpy RNG, and stored here, so each
+      dropout_param keeps its own generator and np.random.seed still makes
+      training reproducible.
 
   Outputs:
   - out: Array of the same shape as x.
-  - cache: A tuple (dropout_param, mask). In training mode, mask is the dropout
-    mask that was used to multiply the input; in test mode, mask is None.
+  - cache: A tuple (dropout_param, mask). In training mode, mask is the keep
+    mask packed to one bit per element with np.packbits; in test mode, mask
+    is None.
   """
   p, mode = dropout_param['p'], dropout_param['mode']
-  if 'seed' in dropout_param:
-    np.random.seed(dropout_param['seed'])
 
   mask = None
   out = None
 
   if mode == 'train':
+    if 'seed' in dropout_param:
+      rng = np.random.default_rng(dropout_param['seed'])
+    else:
+      rng = dropout_param.get('rng')
+      if rng is None:
+        rng = dropout_param['rng'] = np.random.default_rng(
+          np.random.randint(2**32, dtype=np.uint64))
     # ================================================================ #
     # YOUR CODE HERE:
     #   Implement the inverted dropout forward pass during training time.  
@@ -338,8 +349,10 @@ def dropout_forward(x, dropout_param):
     #   dropout mask as the variable mask.
     # ================================================================ #
     
-    mask = (np.random.rand(*x.shape) < p) / p
-    out = mask * x
+    keep = rng.random(x.shape, dtype=np.float32) < p
+    out = x * keep
+    out /= p
+    mask = np.packbits(keep, axis=None)
     
     # ================================================================ #
     # END YOUR CODE HERE
@@ -372,7 +385,7 @@ def dropout_backward(dout, cache):
   - cache: (dropout_param, mask) from dropout_forward.
   """
   dropout_param, mask = cache
-  mode = dropout_param['mode']
+  p, mode = dropout_param['p'], dropout_param['mode']
   
   dx = None
   if mode == 'train':
@@ -381,7 +394,9 @@ def dropout_backward(dout, cache):
     #   Implement the inverted dropout backward pass during training time.
     # ================================================================ #
     
-    dx = dout * mask
+    keep = np.unpackbits(mask, count=dout.size).reshape(dout.shape)
+    dx = dout * keep
+    dx /= p
     
     # ================================================================ #
     # END YOUR CODE HERE
@@ -409,24 +424,65 @@ def svm_loss(x, y):
   - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
     0 <= y[i] < C
 
+  Returns a tuple of:
+  - loss: Scalar giving the loss
+  - dx: Gradient of the loss with respect to x
+  """
+  return svm_hinge_loss(x, y)
+
+
+def svm_hinge_loss(x, y, delta=1.0, grad=True, sparse=False):
+  """
+  Vectorized multiclass SVM (hinge) loss and gradient.
+
+  The margins are computed once into a single (N, C) buffer, clamped in
+  place, and the same buffer is turned into the gradient.
+
+  Inputs:
+  - x: Scores, of shape (N, C) where x[i, j] is the score for the jth class
+    for the ith input.
+  - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
+    0 <= y[i] < C
+  - delta: Scalar margin.
+  - grad: If False, skip the gradient and return None in its place.
+  - sparse: If True, return the gradient as a scipy.sparse CSR matrix whose
+    only nonzeros are the violating margins and the correct-class entries.
+
   Returns a tuple of:
   - loss: Scalar giving the loss
   - dx: Gradient of the loss with respect to x
   """
   N = x.shape[0]
-  correct_class_scores = x[np.arange(N), y]
-  margins = np.maximum(0, x - correct_class_scores[:, np.newaxis] + 1.0)
-  margins[np.arange(N), y] = 0
+  rows = np.arange(N)
+
+  margins = x - x[rows, y][:, np.newaxis]
+  margins += delta
+  margins[rows, y] = 0
+  np.maximum(margins, 0, out=margins)
   loss = np.sum(margins) / N
-  num_pos = np.sum(margins > 0, axis=1)
-  dx = np.zeros_like(x)
-  dx[margins > 0] = 1
-  dx[np.arange(N), y] -= num_pos
+
+  if not grad:
+    return loss, None
+
+  if sparse:
+    from scipy.sparse import csr_matrix
+    viol_rows, viol_cols = np.nonzero(margins)
+    num_pos = np.bincount(viol_rows, minlength=N)
+    data = np.concatenate((np.ones(viol_rows.size), -num_pos)) / N
+    dx = csr_matrix((data.astype(x.dtype, copy=False),
+                     (np.concatenate((viol_rows, rows)),
+                      np.concatenate((viol_cols, y)))),
+                    shape=x.shape)
+    return loss, dx
+
+  # Margins are non-negative here, so sign() gives the 0/1 indicator.
+  dx = np.sign(margins, out=margins)
+  dx[rows, y] = -np.sum(dx, axis=1)
   dx /= N
   return loss, dx
 
 
-def softmax_loss(x, y):
+def softmax_loss(x, y, label_smoothing=0.0, class_weights=None):
   """
   Computes the loss and gradient for softmax classification.
 
@@ -435,17 +491,69 @@ def softmax_loss(x, y):
     for the ith input.
   - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
     0 <= y[i] < C
+  - label_smoothing, class_weights: See softmax_cross_entropy.
 
   Returns a tuple of:
   - loss: Scalar giving the loss
   - dx: Gradient of the loss with respect to x
   """
+  return softmax_cross_entropy(x, y, label_smoothing=label_smoothing,
+                               class_weights=class_weights)
 
-  probs = np.exp(x - np.max(x, axis=1, keepdims=True))
-  probs /= np.sum(probs, axis=1, keepdims=True)
-  N = x.shape[0]
-  loss = -np.sum(np.log(probs[np.arange(N), y])) / N
-  dx = probs.copy()
-  dx[np.arange(N), y] -= 1
-  dx /= N
-  return loss, dx
+
+def softmax_cross_entropy(x, y, label_smoothing=0.0, class_weights=None,
+                          inplace=False):
+  """
+  Fused log-softmax / cross-entropy loss and gradient.
+
+  The max-shift, exponentiation, normalization and the subtraction of the
+  targets are all done on a single (N, C) buffer, which is returned as the
+  gradient. The dtype of x (e.g. float32) is preserved.
+
+  Inputs:
+  - x: Scores, of shape (N, C) where x[i, j] is the score for the jth class
+    for the ith input.
+  - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
+    0 <= y[i] < C
+  - label_smoothing: Scalar in [0, 1). The target for each input is
+    (1 - label_smoothing) on the true class plus label_smoothing / C on
+    every class.
+  - class_weights: Optional array of shape (C,). Each input's loss is
+    weighted by class_weights[y[i]] and the total is normalized by the sum
+    of those weights instead of N.
+  - inplace: If True, x is overwritten and reused as the gradient buffer.
+
+  Returns a tuple of:
+  - loss: Scalar giving the loss
+  - dx: Gradient of the loss with respect to x
+  """
+  N, C = x.shape
+  rows = np.arange(N)
+  dx = x if inplace else x.copy()
+
+  dx -= np.max(dx, axis=1, keepdims=True)
+  # Per-example cross-entropy against the (smoothed) target distribution,
+  # written in terms of the shifted scores before they are exponentiated.
+  losses = -(1.0 - label_smoothing) * dx[rows, y]
+  if label_smoothing:
+    losses -= label_smoothing / C * np.sum(dx, axis=1)
+
+  np.exp(dx, out=dx)
+  sums = np.sum(dx, axis=1)
+  losses += np.log(sums)
+  dx /= sums[:, np.newaxis]
+
+  if label_smoothing:
+    dx -= label_smoothing / C
+  dx[rows, y] -= 1.0 - label_smoothing
+
+  if class_weights is None:
+    loss = np.sum(losses) / N
+    dx /= N
+  else:
+    weights = np.asarray(class_weights)[y]
+    weights = weights / np.sum(weights)
+    loss = np.dot(weights, losses)
+    dx *= weights.astype(dx.dtype)[:, np.newaxis]
+
+  return float(loss), dx
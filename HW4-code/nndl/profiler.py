@@ -0,0 +1,338 @@
+"""
+Opt-in per-layer profiling of the forward and backward passes.
+
+While a LayerProfiler is active, every *_forward*, *_backward* and *_loss
+function of the modules in INSTRUMENTED_MODULES is replaced, in every nndl
+and cs231n module (and __main__) that refers to it, by a wrapper recording
+its wall time, an estimate of its FLOPs, the bytes of the arrays it returns
+and its output shapes. The original functions are put back when the profiler
+stops, so there is no overhead at all when profiling is off.
+
+    with LayerProfiler() as prof:
+      for t in range(10):
+        solver._step()
+        prof.step()
+    print(prof.summary())
+    prof.export_chrome_trace('trace.json')
+
+The trace can be opened in chrome://tracing or https://ui.perfetto.dev, where
+composite layers (e.g. conv_relu_pool_forward) nest over the layers they
+call, as in a flame graph.
+"""
+
+import importlib
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+
+
+INSTRUMENTED_MODULES = ('nndl.layers', 'nndl.conv_layers', 'nndl.layer_utils',
+                        'nndl.conv_layer_utils', 'cs231n.fast_layers')
+
+
+# Approximate FLOPs per output element of the elementwise layers.
+ELEMENTWISE_FLOPS = {
+  'relu': 1,
+  'dropout': 2,
+  'batchnorm': 10,
+  'spatial_batchnorm': 10,
+}
+
+
+def _layer_pass(name):
+  """
+  'forward', 'backward' or 'loss' for the layer functions that are
+  instrumented (e.g. conv_forward_fast, max_pool_backward_naive, svm_loss),
+  None for any other name.
+  """
+  for kind in ('forward', 'backward'):
+    if '_%s' % kind in name:
+      return kind
+  return 'loss' if name.endswith('_loss') else None
+
+
+def _layer_kind(name):
+  """
+  Layer name without the pass and implementation suffixes, e.g. 'conv' for
+  conv_forward_fast and 'max_pool' for max_pool_backward_naive.
+  """
+  for suffix in ('_forward', '_backward'):
+    if suffix in name:
+      return name[:name.index(suffix)]
+  return name
+
+
+def estimate_forward_flops(name, args, out):
+  """
+  Estimated floating point operations of the forward call name(*args) that
+  returned out, or None for layers without an estimate (composite layers are
+  given the sum of the layers they call instead).
+  """
+  kind = _layer_kind(name)
+  if not isinstance(out, np.ndarray):
+    return None
+  if kind == 'affine':
+    x, w = args[0], args[1]
+    return 2 * x.shape[0] * w.shape[0] * w.shape[1] + out.size
+  if kind == 'conv':
+    w = args[1]
+    return 2 * out.size * w[0].size + out.size
+  if kind == 'max_pool':
+    pool_param = args[1]
+    return out.size * pool_param['pool_height'] * pool_param['pool_width']
+  if kind in ELEMENTWISE_FLOPS:
+    return ELEMENTWISE_FLOPS[kind] * out.size
+  if _layer_pass(name) == 'loss':
+    return 10 * args[0].size
+  return None
+
+
+def _array_bytes(obj, exclude, depth=3):
+  """
+  Total nbytes of the arrays reachable from obj through tuples, lists and
+  dicts, skipping the arrays whose id is in exclude (the inputs, which the
+  caches of most layers keep).
+  """
+  if isinstance(obj, np.ndarray):
+    if id(obj) in exclude:
+      return 0
+    exclude.add(id(obj))
+    return obj.nbytes
+  if depth == 0:
+    return 0
+  if isinstance(obj, dict):
+    obj = obj.values()
+  elif not isinstance(obj, (tuple, list)):
+    return 0
+  return sum(_array_bytes(o, exclude, depth - 1) for o in obj)
+
+
+def _outputs(name, result):
+  """
+  The arrays a layer call produces for the next layer: out for a forward
+  pass, the gradients for a backward pass and dx for a loss.
+  """
+  if not isinstance(result, tuple):
+    return (result,)
+  if _layer_pass(name) == 'forward':
+    return result[:1]
+  if _layer_pass(name) == 'loss':
+    return result[1:]
+  return result
+
+
+class LayerProfiler(object):
+  """
+  Records one event per instrumented layer call. Each event is a dictionary
+  with:
+  - name: Function name, e.g. 'conv_forward_strides'.
+  - step: Value of self.step_index when the call was made.
+  - depth: Nesting depth (0 for calls made directly by the model).
+  - start, duration: Wall time in seconds, start relative to the profiler.
+  - self_time: duration minus the time of the instrumented calls it made.
+  - flops: Estimated FLOPs or None; backward passes are estimated as twice
+    their forward pass.
+  - bytes: Bytes of the arrays returned (outputs and caches, excluding the
+    inputs they hold on to).
+  - shapes: Shapes of the outputs (see _outputs).
+  """
+
+  def __init__(self, modules=INSTRUMENTED_MODULES):
+    """
+    Inputs:
+    - modules: Names of the modules whose layer functions are instrumented;
+      those that cannot be imported (e.g. cs231n.fast_layers without its
+      Cython extension) are skipped.
+    """
+    self.modules = modules
+    self.events = []
+    self.step_index = 0
+    self._patched = []
+    self._stack = []
+    self._forward_flops = defaultdict(list)
+    self._step_start = None
+    self._origin = None
+
+  def _wrap(self, fn):
+    name = fn.__name__
+    is_forward = _layer_pass(name) == 'forward'
+    backward_of = name.replace('_backward', '_forward') \
+        if _layer_pass(name) == 'backward' else None
+    stack = self._stack
+
+    def wrapper(*args, **kwargs):
+      frame = [0, 0.0, False]  # flops, time and presence of child calls
+      stack.append(frame)
+      start = time.perf_counter()
+      try:
+        result = fn(*args, **kwargs)
+      finally:
+        end = time.perf_counter()
+        stack.pop()
+      duration = end - start
+
+      outputs = _outputs(name, result)
+      if frame[2]:
+        flops = frame[0]
+      elif backward_of is not None:
+        pending = self._forward_flops[backward_of]
+        flops = 2 * pending.pop() if pending and pending[-1] is not None \
+            else None
+      else:
+        flops = estimate_forward_flops(name, args, outputs[0])
+      if is_forward:
+        # Backward passes run in reverse order, so they pop the estimates.
+        self._forward_flops[name].append(flops)
+      if stack:
+        parent = stack[-1]
+        parent[0] += flops or 0
+        parent[1] += duration
+        parent[2] = True
+
+      self.events.append({
+        'name': name,
+        'step': self.step_index,
+        'depth': len(stack),
+        'start': start - self._origin,
+        'duration': duration,
+        'self_time': duration - frame[1],
+        'flops': flops,
+        'bytes': _array_bytes(result, set(id(a) for a in args)),
+        'shapes': [o.shape for o in outputs if isinstance(o, np.ndarray)],
+      })
+      return result
+
+    wrapper.__name__ = name
+    wrapper.__doc__ = fn.__doc__
+    wrapper.__wrapped__ = fn
+    return wrapper
+
+  def start(self):
+    """
+    Instruments the layer functions. Calls made before start() or after
+    stop() are not recorded and cost nothing extra.
+    """
+    if self._patched:
+      raise RuntimeError('LayerProfiler already started')
+    wrappers = {}
+    for module_name in self.modules:
+      try:
+        module = importlib.import_module(module_name)
+      except ImportError:
+        continue
+      for attr, fn in vars(module).items():
+        if callable(fn) and _layer_pass(attr) is not None and \
+            getattr(fn, '__module__', None) == module_name:
+          wrappers[id(fn)] = (fn, self._wrap(fn))
+
+    for module_name, module in list(sys.modules.items()):
+      if module is None or not (module_name == '__main__' or
+                                module_name.split('.')[0] in ('nndl', 'cs231n')):
+        continue
+      namespace = vars(module)
+      for attr, value in list(namespace.items()):
+        if id(value) in wrappers and wrappers[id(value)][0] is value and \
+            _layer_pass(attr) is not None:
+          namespace[attr] = wrappers[id(value)][1]
+          self._patched.append((namespace, attr, value))
+
+    self._origin = time.perf_counter()
+    self._step_start = self._origin
+    return self
+
+  def stop(self):
+    """
+    Restores the original layer functions.
+    """
+    for namespace, attr, value in self._patched:
+      namespace[attr] = value
+    self._patched = []
+    self._stack[:] = []
+    self._forward_flops.clear()
+
+  def step(self):
+    """
+    Marks the end of a training step: records a 'step' event spanning it and
+    increments step_index. Forward passes without a backward pass (e.g.
+    accuracy checks) are forgotten here.
+    """
+    now = time.perf_counter()
+    self.events.append({
+      'name': 'step', 'step': self.step_index, 'depth': -1,
+      'start': self._step_start - self._origin,
+      'duration': now - self._step_start, 'self_time': 0.0, 'flops': None,
+      'bytes': 0, 'shapes': [],
+    })
+    self._step_start = now
+    self._forward_flops.clear()
+    self.step_index += 1
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *exc):
+    self.stop()
+
+  def layer_stats(self):
+    """
+    Aggregates the events by layer name.
+
+    Returns a dictionary mapping every layer name to a dictionary with the
+    number of calls, total and self time in seconds, total flops (estimated
+    calls only), GFLOP/s over the total time and total bytes.
+    """
+    stats = {}
+    for event in self.events:
+      if event['name'] == 'step':
+        continue
+      s = stats.setdefault(event['name'], {
+        'calls': 0, 'time': 0.0, 'self_time': 0.0, 'flops': 0, 'bytes': 0})
+      s['calls'] += 1
+      s['time'] += event['duration']
+      s['self_time'] += event['self_time']
+      s['flops'] += event['flops'] or 0
+      s['bytes'] += event['bytes']
+    for s in stats.values():
+      s['gflops'] = s['flops'] / s['time'] / 1e9 if s['time'] > 0 else 0.0
+    return stats
+
+  def summary(self, sort_by='self_time'):
+    """
+    Returns a table of layer_stats(), most expensive layer first.
+    """
+    stats = self.layer_stats()
+    lines = ['%-28s %6s %10s %10s %8s %10s' % (
+        'layer', 'calls', 'total ms', 'self ms', 'GFLOP/s', 'MB')]
+    for name in sorted(stats, key=lambda n: -stats[n][sort_by]):
+      s = stats[name]
+      lines.append('%-28s %6d %10.2f %10.2f %8.2f %10.1f' % (
+          name, s['calls'], 1e3 * s['time'], 1e3 * s['self_time'],
+          s['gflops'], s['bytes'] / 2.0**20))
+    return '\n'.join(lines)
+
+  def export_chrome_trace(self, path):
+    """
+    Writes the events in the Chrome trace event format (complete events in
+    microseconds), which chrome://tracing and Perfetto display as a flame
+    chart.
+    """
+    pid = os.getpid()
+    trace = []
+    for event in self.events:
+      trace.append({
+        'name': event['name'] if event['name'] != 'step' else
+                'step %d' % event['step'],
+        'cat': 'step' if event['name'] == 'step' else
+               _layer_kind(event['name']),
+        'ph': 'X', 'pid': pid, 'tid': 0,
+        'ts': 1e6 * event['start'], 'dur': 1e6 * event['duration'],
+        'args': {'step': event['step'], 'flops': event['flops'],
+                 'bytes': event['bytes'],
+                 'shapes': [list(s) for s in event['shapes']]},
+      })
+    with open(path, 'w') as f:
+      json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,250 @@
+from __future__ import print_function, division
+import glob
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+"""
+Compact, asynchronous checkpoints for Solver.
+
+A checkpoint is an .npz file named '%s_epoch_%d.npz' % (prefix, epoch)
+holding the model parameters and the per-parameter optimizer configs
+(learning rate, velocity, moment buffers, ...), together with the counters
+needed to resume. The loss and accuracy histories are not repeated in every
+checkpoint: they are appended, as raw float64 values, to the files
+prefix + '_loss.f64' and prefix + '_acc.f64', and each checkpoint records
+how many entries of them belong to it.
+"""
+
+
+def _checkpoint_path(prefix, epoch):
+    return '%s_epoch_%d.npz' % (prefix, epoch)
+
+
+def _history_paths(prefix):
+    return prefix + '_loss.f64', prefix + '_acc.f64'
+
+
+def checkpoint_prefix(path):
+    """
+    The prefix a checkpoint path was written with.
+    """
+    match = re.match(r'(.*)_epoch_\d+\.npz$', path)
+    if match is None:
+        raise ValueError('Invalid checkpoint path "%s"' % path)
+    return match.group(1)
+
+
+def list_checkpoints(prefix):
+    """
+    Paths of the checkpoints written with prefix, oldest epoch first.
+    """
+    paths = glob.glob(glob.escape(prefix) + '_epoch_*.npz')
+    epochs = {}
+    for path in paths:
+        match = re.match(r'.*_epoch_(\d+)\.npz$', path)
+        if match is not None:
+            epochs[path] = int(match.group(1))
+    return sorted(epochs, key=epochs.get)
+
+
+def latest_checkpoint(prefix):
+    """
+    Path of the checkpoint with the highest epoch written with prefix, or
+    None if there is none.
+    """
+    paths = list_checkpoints(prefix)
+    return paths[-1] if paths else None
+
+
+def flatten_state(params, optim_configs):
+    """
+    Flattens parameters and optimizer configs into a dictionary of arrays
+    for np.savez, with keys 'params/<name>' and 'optim/<name>/<key>'.
+    Scalars are stored as 0-d arrays. The arrays are copied, since the update
+    rules may modify them in place while they are being written.
+    """
+    arrays = {}
+    for name, value in params.items():
+        arrays['params/' + name] = np.array(value)
+    for name, config in optim_configs.items():
+        for key, value in config.items():
+            arrays['optim/%s/%s' % (name, key)] = np.array(value)
+    return arrays
+
+
+def unflatten_state(arrays):
+    """
+    Inverse of flatten_state; 0-d optimizer values are returned as Python
+    scalars.
+    """
+    params, optim_configs = {}, {}
+    for key, value in arrays.items():
+        parts = key.split('/')
+        if parts[0] == 'params':
+            params[parts[1]] = value
+        elif parts[0] == 'optim':
+            config = optim_configs.setdefault(parts[1], {})
+            config[parts[2]] = value.item() if value.ndim == 0 else value
+    return params, optim_configs
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints on a background thread.
+
+    save() takes a snapshot of the state in the calling thread (copies of
+    the arrays and the history entries added since the previous checkpoint)
+    and returns immediately; the files are written by a single worker
+    thread, in order. Each .npz file is written under a temporary name and
+    then renamed, so a crash never leaves a truncated checkpoint behind.
+
+    All checkpoints with the same prefix share the history files. The first
+    checkpoint a writer saves cuts them back to num_losses and num_accs
+    entries (nothing, for a new run) and deletes the checkpoints with this
+    prefix that refer to the entries cut off: starting a new run, or resuming
+    from an earlier checkpoint, under an existing prefix replaces the later
+    checkpoints of the previous run.
+    """
+
+    def __init__(self, prefix, keep_last=None, num_losses=0, num_accs=0):
+        """
+        Inputs:
+        - prefix: Path prefix of the checkpoint and history files.
+        - keep_last: If not None, only the keep_last most recent checkpoints
+          with this prefix are kept.
+        - num_losses, num_accs: Number of loss and accuracy entries already
+          in the history files that belong to the run being continued
+          (e.g. from load_checkpoint); later entries, left by a run that
+          went on past that checkpoint, are discarded when the first new
+          checkpoint is written.
+        """
+        self.prefix = prefix
+        self.keep_last = keep_last
+        self.num_losses = num_losses
+        self.num_accs = num_accs
+        for path, count in zip(_history_paths(prefix), (num_losses, num_accs)):
+            if count and not os.path.exists(path):
+                raise ValueError('Missing history file "%s"' % path)
+        self._truncate = (num_losses, 2 * num_accs)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._future = None
+
+    def save(self, epoch, params, optim_configs, loss_history,
+             train_acc_history, val_acc_history, arrays=None, **counters):
+        """
+        Schedules a checkpoint for epoch.
+
+        Inputs:
+        - epoch: Epoch number used in the file name.
+        - params, optim_configs: Model parameters and optimizer configs.
+        - loss_history, train_acc_history, val_acc_history: The full
+          histories; only the entries added since the last save are written.
+        - arrays: Optional dictionary of extra arrays to store; their names
+          must contain a '/' and not start with 'params/' or 'optim/'.
+        - counters: Extra integer or float values to store (e.g. iteration).
+
+        Returns the path the checkpoint is written to.
+        """
+        self._raise_errors()
+        extra = arrays or {}
+        arrays = flatten_state(params, optim_configs)
+        for key, value in extra.items():
+            arrays[key] = np.array(value)
+        arrays['epoch'] = np.array(epoch)
+        for key, value in counters.items():
+            arrays[key] = np.array(value)
+        losses = np.array(loss_history[self.num_losses:], dtype=np.float64)
+        accs = np.column_stack((train_acc_history[self.num_accs:],
+                                val_acc_history[self.num_accs:])).astype(
+                                    np.float64)
+        self.num_losses = len(loss_history)
+        self.num_accs = len(val_acc_history)
+        arrays['num_losses'] = np.array(self.num_losses)
+        arrays['num_accs'] = np.array(self.num_accs)
+
+        path = _checkpoint_path(self.prefix, epoch)
+        self._future = self._executor.submit(self._write, path, arrays,
+                                             losses, accs, self._truncate)
+        self._truncate = None
+        return path
+
+    def _write(self, path, arrays, losses, accs, truncate=None):
+        for i, (history_path, values) in enumerate(zip(
+                _history_paths(self.prefix), (losses, accs))):
+            if truncate is not None and os.path.exists(history_path):
+                if i == 0:
+                    self._remove_stale(*truncate)
+                os.truncate(history_path, 8 * truncate[i])
+            with open(history_path, 'ab') as f:
+                values.tofile(f)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+        if self.keep_last is not None:
+            for old in list_checkpoints(self.prefix)[:-self.keep_last]:
+                os.remove(old)
+
+    def _remove_stale(self, num_losses, num_acc_values):
+        """
+        Deletes the checkpoints that need more history entries than the
+        files are about to be cut back to.
+        """
+        for old in list_checkpoints(self.prefix):
+            with np.load(old) as data:
+                stale = int(data['num_losses']) > num_losses or \
+                    2 * int(data['num_accs']) > num_acc_values
+            if stale:
+                os.remove(old)
+
+    def _raise_errors(self):
+        if self._future is not None and self._future.done():
+            self._future.result()
+
+    def wait(self):
+        """
+        Blocks until every scheduled checkpoint is on disk, and raises the
+        error of the last one if it failed.
+        """
+        if self._future is not None:
+            self._future.result()
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+
+
+def load_checkpoint(path):
+    """
+    Reads a checkpoint written by CheckpointWriter.
+
+    Returns a dictionary with 'params', 'optim_configs', the histories
+    ('loss_history', 'train_acc_history', 'val_acc_history', as lists), the
+    extra arrays passed to save ('arrays') and every other stored value
+    (e.g. 'epoch', 'num_losses') as a scalar.
+    """
+    with np.load(path) as data:
+        arrays = {key: data[key] for key in data.files}
+    params, optim_configs = unflatten_state(arrays)
+    state = {key: value.item() for key, value in arrays.items()
+             if '/' not in key}
+    state['params'] = params
+    state['optim_configs'] = optim_configs
+    state['arrays'] = {key: value for key, value in arrays.items()
+                       if '/' in key and key.split('/')[0] not in
+                       ('params', 'optim')}
+
+    loss_path, acc_path = _history_paths(checkpoint_prefix(path))
+    losses = np.fromfile(loss_path, dtype=np.float64,
+                         count=state['num_losses'])
+    accs = np.fromfile(acc_path, dtype=np.float64,
+                       count=2 * state['num_accs']).reshape(-1, 2)
+    if losses.size < state['num_losses'] or accs.shape[0] < state['num_accs']:
+        raise ValueError('Incomplete history files for "%s"' % path)
+    state['loss_history'] = losses.tolist()
+    state['train_acc_history'] = accs[:, 0].tolist()
+    state['val_acc_history'] = accs[:, 1].tolist()
+    return state
@@ -0,0 +1,278 @@
+from __future__ import print_function, division
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from nndl.layers import *
+from nndl.conv_layers import *
+from cs231n.fast_layers import *
+
+"""
+Benchmarks for the forward and backward passes of the layers in nndl.layers,
+nndl.conv_layers and cs231n.fast_layers.
+
+Run from the HW5 directory, e.g.
+
+    python -m cs231n.layer_benchmark --out baseline.json
+    python -m cs231n.layer_benchmark --compare baseline.json
+
+Every case is timed over several repetitions (median and minimum are
+reported), throughput is in examples per second, and peak memory is the
+largest amount of memory allocated during one forward and backward pass, as
+measured by tracemalloc (numpy reports its array allocations to it).
+"""
+
+
+def _randn(rng, dtype, *shape):
+    return rng.standard_normal(shape).astype(dtype)
+
+
+def _affine_inputs(shape, dtype, rng):
+    N, D, M = shape
+    return (_randn(rng, dtype, N, D), 0.01 * _randn(rng, dtype, D, M),
+            np.zeros(M, dtype=dtype)), ()
+
+
+def _array_inputs(shape, dtype, rng):
+    return (_randn(rng, dtype, *shape),), ()
+
+
+def _batchnorm_inputs(shape, dtype, rng):
+    D = shape[1]
+    return (_randn(rng, dtype, *shape), np.ones(D, dtype=dtype),
+            np.zeros(D, dtype=dtype)), ({'mode': 'train'},)
+
+
+def _dropout_inputs(shape, dtype, rng):
+    return (_randn(rng, dtype, *shape),), ({'mode': 'train', 'p': 0.5},)
+
+
+def _loss_inputs(shape, dtype, rng):
+    N, C = shape
+    return (_randn(rng, dtype, N, C),), (rng.integers(C, size=N),)
+
+
+def _conv_inputs(shape, dtype, rng):
+    N, C, H, W, F, HH = shape
+    return (_randn(rng, dtype, N, C, H, W),
+            0.01 * _randn(rng, dtype, F, C, HH, HH),
+            np.zeros(F, dtype=dtype)), ({'stride': 1, 'pad': (HH - 1) // 2},)
+
+
+def _pool_inputs(shape, dtype, rng):
+    return (_randn(rng, dtype, *shape),), (
+        {'pool_height': 2, 'pool_width': 2, 'stride': 2},)
+
+
+# name -> (forward, backward, make_inputs, shapes). make_inputs(shape, dtype,
+# rng) returns the arrays and the extra arguments of forward; backward is None
+# for losses, whose forward already returns the gradient. The naive and fast
+# convolution and pooling layers share their smallest shape so that they can
+# be compared directly.
+BENCHMARKS = {
+    'affine': (affine_forward, affine_backward, _affine_inputs,
+               [(128, 3072, 100), (128, 512, 512)]),
+    'relu': (relu_forward, relu_backward, _array_inputs, [(128, 4096)]),
+    'batchnorm': (batchnorm_forward, batchnorm_backward, _batchnorm_inputs,
+                  [(128, 512)]),
+    'dropout': (dropout_forward, dropout_backward, _dropout_inputs,
+                [(128, 4096)]),
+    'svm_loss': (svm_loss, None, _loss_inputs, [(128, 10)]),
+    'softmax_loss': (softmax_loss, None, _loss_inputs, [(128, 10)]),
+    'conv_naive': (conv_forward_naive, conv_backward_naive, _conv_inputs,
+                   [(4, 3, 32, 32, 16, 3)]),
+    'conv_im2col': (conv_forward_im2col, conv_backward_im2col, _conv_inputs,
+                    [(4, 3, 32, 32, 16, 3), (32, 3, 32, 32, 32, 3)]),
+    'conv_fast': (conv_forward_fast, conv_backward_fast, _conv_inputs,
+                  [(4, 3, 32, 32, 16, 3), (32, 3, 32, 32, 32, 3)]),
+    'max_pool_naive': (max_pool_forward_naive, max_pool_backward_naive,
+                       _pool_inputs, [(4, 16, 32, 32)]),
+    'max_pool_fast': (max_pool_forward_fast, max_pool_backward_fast,
+                      _pool_inputs, [(4, 16, 32, 32), (32, 32, 32, 32)]),
+    'spatial_batchnorm': (spatial_batchnorm_forward, spatial_batchnorm_backward,
+                          _batchnorm_inputs, [(32, 32, 16, 16)]),
+}
+
+
+def _timings(fn, repeat):
+    """
+    Calls fn once to warm up, then repeat times, and returns the timing
+    summary of the timed calls.
+    """
+    fn()
+    times = []
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - tic)
+    return {'median': float(np.median(times)), 'min': float(np.min(times))}
+
+
+def benchmark_layer(forward, backward, arrays, args, repeat=7):
+    """
+    Times forward(*arrays, *args) and backward(dout, cache), and measures the
+    peak memory allocated by one forward and backward pass.
+
+    Returns a dictionary with forward and backward timing summaries (median
+    and min seconds, throughput in examples per second; backward is None if
+    backward is None) and peak_bytes.
+    """
+    inputs = tuple(arrays) + tuple(args)
+    num_examples = arrays[0].shape[0]
+    result = {'forward': _timings(lambda: forward(*inputs), repeat),
+              'backward': None}
+    out, cache = forward(*inputs)
+    if backward is not None:
+        dout = np.random.default_rng(0).standard_normal(out.shape).astype(
+            out.dtype)
+        result['backward'] = _timings(lambda: backward(dout, cache), repeat)
+    for phase in ('forward', 'backward'):
+        if result[phase] is not None:
+            result[phase]['throughput'] = num_examples / result[phase]['median']
+
+    del out, cache
+    tracemalloc.start()
+    try:
+        out, cache = forward(*inputs)
+        if backward is not None:
+            backward(dout, cache)
+        result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result
+
+
+def _environment():
+    threads = {name: os.environ.get(name) for name in
+               ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')}
+    return {
+        'numpy': np.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'threads': threads,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def run_benchmarks(names=None, dtypes=('float64', 'float32'), repeat=7,
+                   seed=0, verbose=True):
+    """
+    Runs the cases in BENCHMARKS.
+
+    Inputs:
+    - names: Names of the layers to run; defaults to all of them.
+    - dtypes: Data types every case is run with.
+    - repeat: Number of timed calls per pass.
+    - seed: Seed for the random inputs.
+    - verbose: If true, print one line per case.
+
+    Returns a dictionary with the environment under 'meta' and, under
+    'results', one entry per case keyed 'layer/shape/dtype' (see
+    benchmark_layer). Cases that raise are recorded with an 'error' entry.
+    """
+    if names is None:
+        names = sorted(BENCHMARKS)
+    results = {}
+    for name in names:
+        if name not in BENCHMARKS:
+            raise ValueError('Invalid benchmark "%s"' % name)
+        forward, backward, make_inputs, shapes = BENCHMARKS[name]
+        for shape in shapes:
+            for dtype in dtypes:
+                key = '%s/%s/%s' % (name, 'x'.join(map(str, shape)), dtype)
+                rng = np.random.default_rng(seed)
+                arrays, args = make_inputs(shape, np.dtype(dtype), rng)
+                try:
+                    result = benchmark_layer(forward, backward, arrays, args,
+                                             repeat)
+                except Exception as e:
+                    result = {'error': repr(e)}
+                results[key] = result
+                if verbose:
+                    print(format_result(key, result))
+    return {'meta': _environment(), 'results': results}
+
+
+def format_result(key, result):
+    if 'error' in result:
+        return '%-38s error: %s' % (key, result['error'])
+    line = '%-38s fwd %9.3f ms' % (key, 1e3 * result['forward']['median'])
+    if result['backward'] is not None:
+        line += '  bwd %9.3f ms' % (1e3 * result['backward']['median'])
+    else:
+        line += ' ' * 18
+    return line + '  %10.0f ex/s  %8.2f MB' % (
+        result['forward']['throughput'], result['peak_bytes'] / 2.0**20)
+
+
+def compare_results(results, baseline, threshold=0.2):
+    """
+    Flags the cases of results that got slower or use more memory than in
+    baseline by more than the fraction threshold.
+
+    Inputs:
+    - results, baseline: Dictionaries returned by run_benchmarks (or loaded
+      from their JSON files).
+    - threshold: Allowed relative increase, e.g. 0.2 for 20%.
+
+    Returns a list of (key, metric, baseline_value, value) tuples, where
+    metric is 'forward', 'backward' (median seconds) or 'peak_bytes'.
+    """
+    regressions = []
+    for key, result in sorted(results['results'].items()):
+        base = baseline['results'].get(key)
+        if base is None or 'error' in base or 'error' in result:
+            continue
+        for phase in ('forward', 'backward'):
+            if result[phase] is None or base[phase] is None:
+                continue
+            if result[phase]['median'] > (1 + threshold) * base[phase]['median']:
+                regressions.append((key, phase, base[phase]['median'],
+                                    result[phase]['median']))
+        if result['peak_bytes'] > (1 + threshold) * base['peak_bytes']:
+            regressions.append((key, 'peak_bytes', base['peak_bytes'],
+                                result['peak_bytes']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the forward and backward passes of the layers.')
+    parser.add_argument('--layers', nargs='*', default=None,
+                        help='layers to run (default: all)')
+    parser.add_argument('--dtypes', nargs='*', default=['float64', 'float32'])
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--out', help='write the results to this JSON file')
+    parser.add_argument('--compare',
+                        help='baseline JSON file to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed relative slowdown (default: 0.2)')
+    opts = parser.parse_args(argv)
+
+    results = run_benchmarks(opts.layers, opts.dtypes, opts.repeat)
+    if opts.out:
+        with open(opts.out, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if opts.compare:
+        with open(opts.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, opts.threshold)
+        for key, metric, old, new in regressions:
+            print('REGRESSION %s %s: %.4g -> %.4g (%+.0f%%)' % (
+                key, metric, old, new, 100.0 * (new / old - 1)))
+        if regressions:
+            return 1
+        print('No regressions against %s' % opts.compare)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,303 @@
+from __future__ import print_function, division
+import argparse
+import importlib
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+
+from cs231n.solver import Solver
+
+"""
+End-to-end training throughput of the Solver models.
+
+Each model is trained with Solver on synthetic CIFAR-shaped data (random
+3x32x32 images and labels) for a fixed number of steps, and the time spent in
+each phase of training is reported:
+
+- gather: sampling and indexing the minibatch,
+- forward: model.loss up to and including the loss function,
+- backward: the *_backward layer calls of model.loss,
+- update: the update rule applied to every parameter (and ema_decay's
+  averaging, if enabled),
+- accuracy: the train/val accuracy checks Solver makes.
+
+Run from the HW4-code or HW5 directory, e.g.
+
+    python -m cs231n.solver_benchmark --models cnn --batch-size 50
+    python -m cs231n.solver_benchmark --threads 1 --dtype float64 --out b.json
+
+Models whose module is not part of the tree (nndl.fc_net in HW5, nndl.cnn in
+HW4-code) are reported as skipped.
+"""
+
+
+# name -> (module, class, constructor arguments)
+MODELS = {
+    'cnn': ('nndl.cnn', 'ThreeLayerConvNet',
+            {'num_filters': 32, 'filter_size': 7, 'hidden_dim': 100}),
+    'fc': ('nndl.fc_net', 'FullyConnectedNet',
+           {'hidden_dims': [100, 100, 100]}),
+}
+
+PHASES = ('gather', 'forward', 'backward', 'update', 'accuracy')
+
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                    'MKL_NUM_THREADS')
+
+
+class _PhaseTimer(object):
+    """
+    Accumulates seconds per phase.
+    """
+
+    def __init__(self):
+        self.totals = dict.fromkeys(PHASES, 0.0)
+
+    def timed(self, phase, fn):
+        def wrapper(*args, **kwargs):
+            tic = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.totals[phase] += time.perf_counter() - tic
+        return wrapper
+
+
+class _TimedSolver(Solver):
+    """
+    A Solver that charges the time of every training phase to a _PhaseTimer,
+    from the times Solver._step reports to _time_step, so the step measured
+    is the one Solver runs (including EMA updates and telemetry). The
+    backward layer calls of model.loss are timed by patching the *_backward
+    functions the model's module calls (see _timed_backward); the forward
+    time is the rest of model.loss.
+    """
+
+    def __init__(self, model, data, timer, **kwargs):
+        self.timer = timer
+        self.step_times = []
+        self._backward_total = 0.0
+        super(_TimedSolver, self).__init__(model, data, **kwargs)
+
+    def _step(self):
+        start = time.perf_counter()
+        super(_TimedSolver, self)._step()
+        self.step_times.append(time.perf_counter() - start)
+
+    def _time_step(self, start, gathered, computed, end):
+        totals = self.timer.totals
+        totals['gather'] += gathered - start
+        # model.loss includes the backward layer calls timed since the last
+        # step; the rest of it is the forward pass.
+        backward = totals['backward'] - self._backward_total
+        self._backward_total = totals['backward']
+        totals['forward'] += computed - gathered - backward
+        totals['update'] += end - computed
+
+    def check_accuracy(self, *args, **kwargs):
+        return self.timer.timed('accuracy', super(
+            _TimedSolver, self).check_accuracy)(*args, **kwargs)
+
+
+class _timed_backward(object):
+    """
+    Context manager that wraps the *_backward functions in the namespace of
+    module so that their time is charged to timer's 'backward' phase. Only
+    the names module calls directly are wrapped, so composite layers such as
+    conv_relu_pool_backward are not counted twice.
+    """
+
+    def __init__(self, module, timer):
+        self.module = module
+        self.timer = timer
+        self.saved = {}
+
+    def __enter__(self):
+        for name, fn in list(vars(self.module).items()):
+            if name.endswith('_backward') and callable(fn):
+                self.saved[name] = fn
+                setattr(self.module, name, self.timer.timed('backward', fn))
+        return self
+
+    def __exit__(self, *exc):
+        for name, fn in self.saved.items():
+            setattr(self.module, name, fn)
+        self.saved = {}
+
+
+def synthetic_data(num_train, num_val, dtype=np.float32, num_classes=10,
+                   seed=0):
+    """
+    Random CIFAR-shaped data in the format Solver expects.
+    """
+    rng = np.random.default_rng(seed)
+    return {
+        'X_train': rng.standard_normal((num_train, 3, 32, 32)).astype(dtype),
+        'y_train': rng.integers(num_classes, size=num_train),
+        'X_val': rng.standard_normal((num_val, 3, 32, 32)).astype(dtype),
+        'y_val': rng.integers(num_classes, size=num_val),
+    }
+
+
+def _reset_peak_rss():
+    """
+    Resets the peak resident set size of this process where the kernel
+    supports it (Linux); returns whether it did.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process in bytes.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def benchmark_model(name, num_steps=20, batch_size=50, dtype='float32',
+                    update_rule='adam', num_val=1000, seed=0):
+    """
+    Trains the model registered under name in MODELS for num_steps steps.
+
+    Inputs:
+    - name: Model name, a key of MODELS.
+    - num_steps: Number of training steps (one epoch of synthetic data).
+    - batch_size: Minibatch size.
+    - dtype: Data and parameter type.
+    - update_rule: Update rule in nndl.optim.
+    - num_val: Number of synthetic validation images; the train accuracy
+      check uses Solver's default of 1000 samples.
+    - seed: Seed for the data and model initialization.
+
+    Returns a dictionary with the total seconds per phase ('phases'), the
+    wall time, the median step time, samples_per_sec (training samples per
+    second of wall time, accuracy checks included), train_samples_per_sec
+    (excluding the accuracy checks) and peak_rss in bytes. peak_rss_exact is
+    False if the peak could not be reset before training, in which case
+    peak_rss is the peak of the whole process so far. If the model's module
+    cannot be imported, returns {'skipped': reason}.
+    """
+    if name not in MODELS:
+        raise ValueError('Invalid model "%s"' % name)
+    module_name, class_name, params = MODELS[name]
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError as e:
+        return {'skipped': repr(e)}
+
+    dtype = np.dtype(dtype)
+    np.random.seed(seed)
+    data = synthetic_data(num_steps * batch_size, num_val, dtype, seed=seed)
+    model = getattr(module, class_name)(dtype=dtype, **params)
+
+    timer = _PhaseTimer()
+    solver = _TimedSolver(model, data, timer, update_rule=update_rule,
+                          optim_config={'learning_rate': 1e-3},
+                          batch_size=batch_size, num_epochs=1, verbose=False)
+    exact_rss = _reset_peak_rss()
+    tic = time.perf_counter()
+    with _timed_backward(module, timer):
+        solver.train()
+    wall = time.perf_counter() - tic
+
+    num_samples = num_steps * batch_size
+    train_time = wall - timer.totals['accuracy']
+    result = {
+        'phases': timer.totals,
+        'wall': wall,
+        'step_median': float(np.median(solver.step_times)),
+        'samples_per_sec': num_samples / wall,
+        'train_samples_per_sec': num_samples / train_time,
+        'peak_rss': peak_rss(),
+        'peak_rss_exact': exact_rss,
+    }
+    return result
+
+
+def format_result(name, result):
+    if 'skipped' in result:
+        return '%-6s skipped: %s' % (name, result['skipped'])
+    wall = result['wall']
+    lines = ['%-6s %8.0f samples/s (%.0f excluding accuracy checks), '
+             'step %.1f ms, peak RSS %.0f MB' % (
+                 name, result['samples_per_sec'],
+                 result['train_samples_per_sec'], 1e3 * result['step_median'],
+                 result['peak_rss'] / 2.0**20)]
+    for phase in PHASES:
+        seconds = result['phases'][phase]
+        lines.append('       %-9s %8.3f s  %5.1f%%' % (
+            phase, seconds, 100 * seconds / wall))
+    return '\n'.join(lines)
+
+
+def _environment():
+    return {
+        'numpy': np.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'threads': {name: os.environ.get(name) for name in THREAD_VARIABLES},
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark end-to-end Solver training throughput.')
+    parser.add_argument('--models', nargs='*', default=sorted(MODELS))
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--dtype', default='float32')
+    parser.add_argument('--update-rule', default='adam')
+    parser.add_argument('--threads', type=int,
+                        help='number of BLAS/OpenMP threads')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    opts = parser.parse_args(argv)
+
+    # BLAS libraries read their thread count when numpy is first imported,
+    # so the process is restarted with the variables set.
+    if opts.threads is not None:
+        value = str(opts.threads)
+        if any(os.environ.get(v) != value for v in THREAD_VARIABLES):
+            for v in THREAD_VARIABLES:
+                os.environ[v] = value
+            args = sys.argv[1:] if argv is None else list(argv)
+            os.execv(sys.executable,
+                     [sys.executable, '-m', __spec__.name] + args)
+
+    results = {}
+    for name in opts.models:
+        results[name] = benchmark_model(
+            name, opts.steps, opts.batch_size, opts.dtype, opts.update_rule)
+        print(format_result(name, results[name]))
+    results = {'meta': dict(_environment(), batch_size=opts.batch_size,
+                            steps=opts.steps, dtype=opts.dtype,
+                            update_rule=opts.update_rule),
+               'results': results}
+    if opts.out:
+        with open(opts.out, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,241 @@
+from __future__ import print_function, division
+import csv
+import json
+import os
+import queue
+import resource
+import sys
+import threading
+import time
+
+import numpy as np
+
+"""
+Training telemetry for Solver.
+
+A Telemetry object keeps the per-iteration metrics Solver records (timing
+breakdown, learning rate, gradient norms, samples/sec, ...) in a fixed-size
+ring buffer of numpy records, and hands them in batches to a background
+thread that writes them to its sinks, so the training loop never waits on a
+file. A sink is a JSONLinesSink, a CSVSink, or any callable taking a list of
+record dictionaries (called from the writer thread).
+
+Example usage:
+
+    telemetry = Telemetry(sinks=[JSONLinesSink('metrics.jsonl')])
+    solver = Solver(model, data, telemetry=telemetry, ...)
+    solver.train()
+    telemetry.close()
+    recent = telemetry.buffer.to_array()
+"""
+
+
+def current_rss():
+    """
+    Current resident set size of this process in bytes. Falls back to the
+    peak RSS where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class MetricsBuffer(object):
+    """
+    Ring buffer holding the last capacity records as a numpy structured
+    array. The fields are taken from the first record: those named in
+    int_fields (by default the iteration and epoch counters and the RSS in
+    bytes) are stored as int64 and everything else as float64, so that a
+    value that happens to be an integer in the first record (e.g. a learning
+    rate of 1) does not truncate later ones. Later records may omit fields
+    (stored as NaN or -1) but not add new ones.
+    """
+
+    def __init__(self, capacity=4096, int_fields=('iteration', 'epoch', 'rss')):
+        self.capacity = capacity
+        self.int_fields = int_fields
+        self.data = None
+        self.count = 0
+
+    def append(self, record):
+        if self.data is None:
+            dtype = [(k, np.int64 if k in self.int_fields else np.float64)
+                     for k in record]
+            self.data = np.empty(self.capacity, dtype=dtype)
+        row = self.data[self.count % self.capacity]
+        for name in self.data.dtype.names:
+            value = record.get(name)
+            if value is None:
+                value = -1 if self.data.dtype[name].kind == 'i' else np.nan
+            row[name] = value
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def rows(self, start, end):
+        """
+        Copy of records start, ..., end - 1 (counted since the buffer was
+        created); those already overwritten are left out.
+        """
+        start = max(start, self.count - self.capacity, 0)
+        if self.data is None or start >= end:
+            return np.empty(0, dtype=self.data.dtype if self.data is not None
+                            else np.float64)
+        idx = np.arange(start, end) % self.capacity
+        return self.data[idx]
+
+    def to_array(self):
+        """
+        The retained records in chronological order.
+        """
+        return self.rows(0, self.count)
+
+
+def _to_dicts(rows):
+    names = rows.dtype.names
+    return [dict(zip(names, row.tolist())) for row in rows]
+
+
+class JSONLinesSink(object):
+    """
+    Writes every record as one JSON object per line.
+    """
+
+    def __init__(self, path, mode='a'):
+        self.f = open(path, mode)
+
+    def write(self, records):
+        self.f.write(''.join(json.dumps(r) + '\n' for r in records))
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class CSVSink(object):
+    """
+    Writes the records as CSV rows, with a header line taken from the first
+    record.
+    """
+
+    def __init__(self, path, mode='w'):
+        self.f = open(path, mode, newline='')
+        self.writer = None
+
+    def write(self, records):
+        if not records:
+            return
+        if self.writer is None:
+            self.writer = csv.DictWriter(self.f, fieldnames=list(records[0]))
+            self.writer.writeheader()
+        self.writer.writerows(records)
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class Telemetry(object):
+    """
+    Collects metrics records and streams them asynchronously to sinks.
+    """
+
+    def __init__(self, sinks=(), capacity=4096, flush_every=50, rss=True):
+        """
+        Inputs:
+        - sinks: JSONLinesSink, CSVSink or callables receiving a list of
+          record dictionaries; they are only ever called from the writer
+          thread.
+        - capacity: Number of records kept in memory (see MetricsBuffer).
+        - flush_every: Records are handed to the writer thread in batches of
+          this many; must not exceed capacity.
+        - rss: If true, the current RSS in bytes is added to every record.
+        """
+        if flush_every > capacity:
+            raise ValueError('flush_every must not exceed capacity')
+        self.sinks = list(sinks)
+        self.buffer = MetricsBuffer(capacity)
+        self.flush_every = flush_every
+        self.rss = rss
+        self.errors = []
+        self._flushed = 0
+        self._origin = time.time()
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def record(self, **fields):
+        """
+        Appends a record with the given fields, plus 'time' (seconds since
+        the Telemetry was created) and 'rss'. Does not block: sinks only
+        see the record once a batch of flush_every records is complete.
+        """
+        fields['time'] = time.time() - self._origin
+        if self.rss:
+            fields['rss'] = current_rss()
+        self.buffer.append(fields)
+        if self.buffer.count - self._flushed >= self.flush_every:
+            self.flush()
+
+    def flush(self, wait=False):
+        """
+        Hands the records not yet written to the writer thread. If wait is
+        true, also waits until every sink has received them.
+        """
+        if self.buffer.count > self._flushed:
+            rows = self.buffer.rows(self._flushed, self.buffer.count)
+            self._flushed = self.buffer.count
+            if self.sinks:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._write_loop,
+                                                    daemon=True)
+                    self._thread.start()
+                self._queue.put(rows)
+        if wait and self._thread is not None:
+            self._queue.join()
+
+    def _write_loop(self):
+        while True:
+            rows = self._queue.get()
+            try:
+                if rows is None:
+                    return
+                records = _to_dicts(rows)
+                for sink in self.sinks:
+                    try:
+                        if hasattr(sink, 'write'):
+                            sink.write(records)
+                        else:
+                            sink(records)
+                    except Exception as e:
+                        # A failing sink must not stop the others or the
+                        # training loop; the errors are kept for inspection.
+                        self.errors.append(e)
+            finally:
+                self._queue.task_done()
+
+    def close(self):
+        """
+        Writes the remaining records, stops the writer thread and closes the
+        sinks that have a close() method.
+        """
+        self.flush()
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        for sink in self.sinks:
+            if hasattr(sink, 'close'):
+                sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
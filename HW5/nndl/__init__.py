@@ -4,3 +4,4 @@ from .conv_layers import *
 from .layer_utils import *
 from .layers import *
 from .optim import *
+from .profiler import LayerProfiler, estimate_forward_flops
@@ -149,6 +149,24 @@ class ThreeLayerConvNet(object):
     # ================================================================ #
 
     return loss, grads
+
+
+  def scores(self, X):
+    """
+    Test-time classification scores, equal to self.loss(X), computed without
+    keeping the caches of the layers so that each intermediate activation
+    can be freed as soon as the next one is computed. Used by Solver to
+    check accuracy.
+    """
+    W1, b1 = self.params['W1'], self.params['b1']
+    W2, b2 = self.params['W2'], self.params['b2']
+    W3, b3 = self.params['W3'], self.params['b3']
+    conv_param = {'stride': 1, 'pad': (W1.shape[2] - 1) / 2}
+    pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+
+    out = conv_relu_pool_forward(X, W1, b1, conv_param, pool_param)[0]
+    out = affine_relu_forward(out, W2, b2)[0]
+    return affine_forward(out, W3, b3)[0]
   
   
 pass
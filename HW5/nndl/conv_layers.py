@@ -226,8 +226,8 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
       old information is discarded completely at every time step, while
       momentum=1 means that new information is never incorporated. The
       default of momentum=0.9 should work well in most situations.
-    - running_mean: Array of shape (D,) giving running mean of features
-    - running_var Array of shape (D,) giving running variance of features
+    - running_mean: Array of shape (C,) giving running mean of features
+    - running_var Array of shape (C,) giving running variance of features
     
   Returns a tuple of:
   - out: Output data, of shape (N, C, H, W)
@@ -246,42 +246,49 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
   mode = bn_param['mode']
   eps = bn_param.get('eps', 1e-5)
   momentum = bn_param.get('momentum', 0.9)
-    
+
+  # Statistics are taken per channel over the (N, H, W) axes directly on the
+  # NCHW tensor, so no transposed (N*H*W, C) copy of x is ever made.
   N, C, H, W = x.shape
-  x = x.reshape((N * H * W, C))
-  _, D = x.shape
+  axes = (0, 2, 3)
 
-  running_mean = bn_param.get('running_mean', np.zeros(D, dtype=x.dtype))
-  running_var = bn_param.get('running_var', np.zeros(D, dtype=x.dtype))
+  # The running statistics are allocated once and then updated in place.
+  if 'running_mean' not in bn_param:
+    bn_param['running_mean'] = np.zeros(C, dtype=x.dtype)
+  if 'running_var' not in bn_param:
+    bn_param['running_var'] = np.zeros(C, dtype=x.dtype)
+  running_mean = bn_param['running_mean']
+  running_var = bn_param['running_var']
 
   if mode == "train":
-    mean = np.mean(x, axis=0)
-    variance = np.var(x, axis=0)
-    x_norm = (x - mean) / np.sqrt(variance + eps)
-    
-    out = gamma * x_norm + beta
-    
-    running_mean = momentum * running_mean + (1 - momentum) * mean
-    running_var = momentum * running_var + (1 - momentum) * variance
-  elif mode == "test":
-    x_norm = (x - running_mean) / np.sqrt(running_var + eps)
-    out = gamma * x_norm + beta
-  else:
-    raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
-  
-  bn_param['running_mean'] = running_mean
-  bn_param['running_var'] = running_var
+    mean = np.mean(x, axis=axes)
+    variance = np.var(x, axis=axes)
+    inv_std = 1.0 / np.sqrt(variance + eps)
 
-  out = out.reshape((N, C, H, W))
-    
-  cache = {
-        "variance": variance,
+    x_norm = x - mean[:, None, None]
+    x_norm *= inv_std[:, None, None]
+
+    out = x_norm * gamma[:, None, None]
+    out += beta[:, None, None]
+
+    running_mean *= momentum
+    running_mean += (1 - momentum) * mean
+    running_var *= momentum
+    running_var += (1 - momentum) * variance
+
+    cache = {
         "x_norm": x_norm,
         "gamma": gamma,
-        "beta": beta,
-        "x_centralized": x - mean,
-        "eps": eps
+        "inv_std": inv_std
     }
+  elif mode == "test":
+    inv_std = 1.0 / np.sqrt(running_var + eps)
+    scale = gamma * inv_std
+    shift = beta - running_mean * scale
+    out = x * scale[:, None, None]
+    out += shift[:, None, None]
+  else:
+    raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
 
   # ================================================================ #
   # END YOUR CODE HERE
@@ -313,31 +320,24 @@ def spatial_batchnorm_backward(dout, cache):
   #   implemented in HW #4.
   # ================================================================ #
   
-  N_original, C, H, W = dout.shape
-  dout = dout.reshape((N_original * W * H, C))
-  N = dout.shape[0]
+  N, C, H, W = dout.shape
+  M = N * H * W
+  axes = (0, 2, 3)
 
   x_norm = cache["x_norm"]
   gamma = cache["gamma"]
-  variance = cache["variance"]
-  x_centralized = cache["x_centralized"]
-  eps = cache["eps"]
+  inv_std = cache["inv_std"]
 
-  dbeta = np.sum(dout, axis=0)
-  dgamma = np.sum(dout * x_norm, axis=0)
+  dbeta = np.sum(dout, axis=axes)
+  dgamma = np.sum(dout * x_norm, axis=axes)
 
-  dx_norm = dout * gamma
-  
-  da = dx_norm / np.sqrt(variance + eps)
-  
-  dvardx = 2 * (x_centralized) / N
-  dvar = -0.5 * np.sum(x_centralized * ((variance + eps) ** -1.5) * dx_norm, axis=0)
-    
-  du = -1 * np.sum(dx_norm, axis=0) / np.sqrt(variance + eps)
+  # Closed form of the batchnorm gradient, reduced per channel in NCHW:
+  #   dx = gamma * inv_std / M * (M * dout - dbeta - x_norm * dgamma)
+  dx = x_norm * (-dgamma / M)[:, None, None]
+  dx += dout
+  dx -= (dbeta / M)[:, None, None]
+  dx *= (gamma * inv_std)[:, None, None]
 
-  dx = da + (dvardx * dvar) + (du / N)
-  dx = dx.reshape((N_original, C, H, W))
-    
   # ================================================================ #
   # END YOUR CODE HERE
   # ================================================================ # 